@@ -14,11 +14,33 @@ from rasa_sdk.events import SlotSet
 
 # import requests
 import logging
-from aiohttp import ClientSession
+
+from actions.chatwoot_client import ChatwootClient, register_with_action_server
+from actions.labels import LabelCache
+from actions.side_effects import SideEffects
 
 
 # logging.basicConfig(encoding='utf-8', level=logging.DEBUG)
 
+# one client with pooled connections for all actions, configured by CHATWOOT_* environment variables
+chatwoot = ChatwootClient.from_env()
+# with a spool, chatwoot operations of actions are applied in the background
+side_effects = SideEffects(
+    chatwoot,
+    os.environ.get('CHATWOOT_SIDE_EFFECTS_SPOOL'),
+    workers=int(os.environ.get('CHATWOOT_SIDE_EFFECTS_WORKERS', 8)),
+    attempts=int(os.environ.get('CHATWOOT_SIDE_EFFECTS_ATTEMPTS', 10)),
+)
+conversation_labels = LabelCache(
+    chatwoot,
+    ttl_seconds=float(os.environ.get('CHATWOOT_LABEL_CACHE_SECONDS', 300)),
+    write_delay_seconds=float(os.environ.get('CHATWOOT_LABEL_WRITE_DELAY_SECONDS', 0.5)),
+    side_effects=side_effects,
+)
+# sanic runs stop listeners in reverse order: labels are written, then the spool stops, then the client closes
+register_with_action_server(chatwoot, side_effects, conversation_labels)
+
+
 def is_working_time():
     now = datetime.datetime.now().time()
 
@@ -34,25 +56,7 @@ def is_working_time():
 
 # send request to chatwoot
 async def chatwoot_request(url: str, method: str = 'post', payload: Dict = None) -> Dict:
-    token = os.environ["CHATWOOT_API_KEY"]
-    chatwoot_url = os.environ["CHATWOOT_URL"]
-    url = f'{chatwoot_url}/api/v1{url}'
-
-    headers = {
-        'Content-Type': "application/json",
-        'api_access_token': token
-    }
-    async with ClientSession(headers=headers, raise_for_status=True) as session: 
-        if method == 'post':
-            response = await session.post(url=url, json=payload, headers=headers)
-        else:
-            response = await session.get(url=url, headers=headers)
-
-        async with response:
-            logging.info(f'chatwoot request ->: {method} {response.url} {payload}')
-            data = await response.json()
-            logging.info(f'chatwoot response <-: {response.status} {data}')
-            return data
+    return await chatwoot.request(method, url, payload)
 
 
 # send get request to chatwoot
@@ -74,6 +78,12 @@ async def chatwoot_open_conversation(conversation_id: int, account_id: int) -> D
     return response['payload']
 
 
+# change conversation status to open, in the background if a side effects spool is configured
+async def chatwoot_open_conversation_deferred(conversation_id: int, account_id: int) -> None:
+    url = f'/accounts/{account_id}/conversations/{conversation_id}/toggle_status'
+    await side_effects.apply(account_id, conversation_id, 'post', url, {"status": "open"})
+
+
 # get conversation labels
 async def chatwoot_get_conversation_labels(conversation_id: int, account_id: int) -> Dict:
     url = f'/accounts/{account_id}/conversations/{conversation_id}/labels'
@@ -140,9 +150,8 @@ class ActionTagConversation(Action):
         (account_id, conversation_id) = get_chatwoot_metadata(metadata)
 
         if account_id and conversation_id:
-            chatwoot_labels = await chatwoot_get_conversation_labels(conversation_id, account_id)
             rasa_labels = [tracker.get_intent_of_latest_message(skip_fallback_intent=False)]
-            await chatwoot_label_conversation(chatwoot_labels + rasa_labels, conversation_id, account_id)
+            await conversation_labels.add(account_id, conversation_id, rasa_labels)
 
         return []
 
@@ -164,7 +173,7 @@ class ActionHandoff(Action):
         (account_id, conversation_id) = get_chatwoot_metadata(metadata)
 
         if account_id and conversation_id:
-            await chatwoot_open_conversation(conversation_id, account_id)
+            await chatwoot_open_conversation_deferred(conversation_id, account_id)
 
         return []
 
@@ -209,7 +218,7 @@ class ActionDefaultFallback(Action):
         (account_id, conversation_id) = get_chatwoot_metadata(metadata)
 
         if account_id and conversation_id:
-            await chatwoot_open_conversation(conversation_id, account_id)
+            await chatwoot_open_conversation_deferred(conversation_id, account_id)
 
         return []
 
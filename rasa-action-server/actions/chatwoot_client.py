@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import os
+import random
+import re
+import time
+from typing import Any, Dict, Optional
+
+import aiohttp
+
+from actions.rate_limit import AccountRateLimiter, parse_retry_after
+
+logger = logging.getLogger(__name__)
+
+# answers for which it is safe to send the request again
+RETRY_STATUSES = {502, 503, 504}
+ACCOUNT_PATH = re.compile(r'^/accounts/([^/]+)/')
+
+
+class ChatwootClient:
+    """Client of the Chatwoot API shared by all actions of the process.
+
+    Requests go over a bounded pool of keep-alive connections, with cached DNS
+    lookups. The session is opened when the action server starts, or by the
+    first request, and closed when the server stops. Connection errors and
+    502/503/504 answers are retried with backoff, timeouts only for GET
+    requests. With a `limiter`, requests are rate limited per account, see
+    `AccountRateLimiter`.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        api_key: str,
+        pool_size: int = 20,
+        timeout_seconds: float = 10,
+        attempts: int = 3,
+        backoff_seconds: float = 0.2,
+        dns_cache_seconds: int = 300,
+        limiter: Optional[AccountRateLimiter] = None,
+        deadline_seconds: float = 30,
+    ) -> None:
+        self.url = url
+        self.api_key = api_key
+        self.pool_size = pool_size
+        self.timeout_seconds = timeout_seconds
+        self.attempts = max(1, attempts)
+        self.backoff_seconds = backoff_seconds
+        self.dns_cache_seconds = dns_cache_seconds
+        self.limiter = limiter
+        self.deadline_seconds = deadline_seconds
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    @classmethod
+    def from_env(cls) -> "ChatwootClient":
+        rate = float(os.environ.get('CHATWOOT_RATE_LIMIT_PER_SECOND', 20))
+        limiter = AccountRateLimiter(
+            rate,
+            float(os.environ.get('CHATWOOT_RATE_LIMIT_BURST', 2 * rate)),
+            max_waiting=int(os.environ.get('CHATWOOT_RATE_LIMIT_MAX_WAITING', 1000)),
+        ) if rate > 0 else None
+        return cls(
+            os.environ.get('CHATWOOT_URL', ''),
+            os.environ.get('CHATWOOT_API_KEY', ''),
+            pool_size=int(os.environ.get('CHATWOOT_POOL_SIZE', 20)),
+            timeout_seconds=float(os.environ.get('CHATWOOT_TIMEOUT_SECONDS', 10)),
+            attempts=int(os.environ.get('CHATWOOT_ATTEMPTS', 3)),
+            limiter=limiter,
+            deadline_seconds=float(os.environ.get('CHATWOOT_RATE_LIMIT_DEADLINE_SECONDS', 30)),
+        )
+
+    def _session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            if not self.url or not self.api_key:
+                raise RuntimeError('CHATWOOT_URL and CHATWOOT_API_KEY have to be set')
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.pool_size, ttl_dns_cache=self.dns_cache_seconds, keepalive_timeout=30
+                ),
+                headers={'Content-Type': 'application/json', 'api_access_token': self.api_key},
+                timeout=aiohttp.ClientTimeout(total=self.timeout_seconds),
+            )
+        return self.session
+
+    async def start(self) -> None:
+        self._session()
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def register(self, app: Any) -> None:
+        """Open and close the session with the server of a Sanic app."""
+        async def start(app, loop) -> None:
+            await self.start()
+
+        async def close(app, loop) -> None:
+            await self.close()
+
+        app.register_listener(start, 'before_server_start')
+        app.register_listener(close, 'after_server_stop')
+
+    async def request(
+        self, method: str, path: str, payload: Optional[Dict] = None, timeout: Optional[float] = None
+    ) -> Any:
+        """Send a request to a path of the Chatwoot API below /api/v1, returns the json answer."""
+        match = ACCOUNT_PATH.match(path)
+        account_id = match.group(1) if match else None
+        url = f'{self.url}/api/v1{path}'
+        # without a timeout of its own, the request has the timeout of the session
+        options = {'timeout': aiohttp.ClientTimeout(total=timeout)} if timeout else {}
+        deadline = time.monotonic() + self.deadline_seconds
+        attempt = 0
+        while True:
+            if self.limiter:
+                await self.limiter.acquire(account_id, deadline)
+            started = time.monotonic()
+            try:
+                async with self._session().request(method, url, json=payload, **options) as response:
+                    logger.debug(f'chatwoot request ->: {method} {response.url} {payload}')
+                    if response.status == 429 and self.limiter:
+                        # sent again once the rate limiter allows it, or fails with RateLimited at the deadline
+                        self.limiter.throttled(account_id, parse_retry_after(response.headers.get('Retry-After')))
+                        continue
+                    if response.status not in RETRY_STATUSES or attempt + 1 >= self.attempts:
+                        response.raise_for_status()
+                        if self.limiter:
+                            self.limiter.succeeded(account_id)
+                        data = await response.json()
+                        logger.info(f'chatwoot {method} {path} <-: {response.status} in {time.monotonic() - started:.3f}s')
+                        logger.debug(f'chatwoot response <-: {data}')
+                        return data
+                    error = f'status {response.status}'
+            except asyncio.TimeoutError:
+                if method.lower() != 'get' or attempt + 1 >= self.attempts:
+                    raise
+                error = 'timeout'
+            except aiohttp.ClientConnectionError as e:
+                if attempt + 1 >= self.attempts:
+                    raise
+                error = str(e)
+            attempt += 1
+            delay = random.uniform(0, self.backoff_seconds * 2 ** attempt)
+            logger.warning(f'chatwoot {method} {path} failed ({error}), retrying in {delay:.2f}s')
+            await asyncio.sleep(delay)
+
+
+def register_with_action_server(*services: Any) -> None:
+    """Tie services like the client to the rasa_sdk server, which exists when actions are loaded."""
+    try:
+        from sanic import Sanic
+        app = Sanic.get_app('rasa_sdk')
+    except Exception as e:
+        # e.g. actions imported outside of the action server, the session is opened on first use
+        logger.debug(f'No action server to register with: {e}')
+        return
+    for service in services:
+        service.register(app)
+
+# flake8: noqa: E501
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Iterable, List, Optional, Set
+
+from actions.chatwoot_client import ChatwootClient
+from actions.side_effects import SideEffects
+
+logger = logging.getLogger(__name__)
+
+
+class ConversationLabels:
+    def __init__(self, labels: List[str]) -> None:
+        self.labels = labels
+        self.loaded = time.monotonic()
+        # labels added since the last write
+        self.pending: List[str] = []
+        self.writing: Optional[asyncio.Future] = None
+
+
+class LabelCache:
+    """Labels of Chatwoot conversations, read once and written in the background.
+
+    The labels of a conversation are read on first use and kept for
+    `ttl_seconds`. Adding labels a conversation has already costs no request.
+    New labels are written after `write_delay_seconds`, so the labels added
+    within that time are written together, and the writes of a conversation
+    never overlap. As Chatwoot replaces all labels of a conversation on a
+    write, the labels are read again right before each write and the new ones
+    added to them, so labels changed by agents or other workers are kept.
+    Writes go through `side_effects`, so with its spool they are retried after
+    failures and restarts.
+    """
+
+    def __init__(
+        self,
+        client: ChatwootClient,
+        ttl_seconds: float = 300,
+        write_delay_seconds: float = 0.5,
+        max_size: int = 10000,
+        side_effects: Optional[SideEffects] = None,
+    ) -> None:
+        self.client = client
+        # without a spool, operations are applied right away
+        self.side_effects = side_effects or SideEffects(client)
+        self.ttl_seconds = ttl_seconds
+        self.write_delay_seconds = write_delay_seconds
+        self.max_size = max_size
+        self.conversations: "OrderedDict[Hashable, ConversationLabels]" = OrderedDict()
+        self.writes: Set[asyncio.Future] = set()
+
+    @staticmethod
+    def path(account_id: Any, conversation_id: Any) -> str:
+        return f'/accounts/{account_id}/conversations/{conversation_id}/labels'
+
+    async def _conversation(self, account_id: Any, conversation_id: Any) -> ConversationLabels:
+        key = (account_id, conversation_id)
+        conversation = self.conversations.get(key)
+        if conversation is not None and (
+            conversation.writing or time.monotonic() - conversation.loaded < self.ttl_seconds
+        ):
+            self.conversations.move_to_end(key)
+            return conversation
+        response = await self.client.request('get', self.path(account_id, conversation_id))
+        # labels added while reading are kept
+        current = self.conversations.get(key)
+        if current is not None and current.writing:
+            return current
+        conversation = self.conversations[key] = ConversationLabels(list(response['payload']))
+        self.conversations.move_to_end(key)
+        while len(self.conversations) > self.max_size:
+            self.conversations.popitem(last=False)
+        return conversation
+
+    async def get(self, account_id: Any, conversation_id: Any) -> List[str]:
+        return list((await self._conversation(account_id, conversation_id)).labels)
+
+    async def add(self, account_id: Any, conversation_id: Any, labels: Iterable[str]) -> None:
+        """Add labels to a conversation, the write happens in the background."""
+        conversation = await self._conversation(account_id, conversation_id)
+        new = [label for label in dict.fromkeys(labels) if label and label not in conversation.labels]
+        if not new:
+            return
+        conversation.labels.extend(new)
+        conversation.pending.extend(new)
+        if conversation.writing is None:
+            conversation.writing = asyncio.ensure_future(self._write(account_id, conversation_id, conversation))
+            self.writes.add(conversation.writing)
+            conversation.writing.add_done_callback(self.writes.discard)
+
+    async def _write(self, account_id: Any, conversation_id: Any, conversation: ConversationLabels) -> None:
+        try:
+            while conversation.pending:
+                await asyncio.sleep(self.write_delay_seconds)
+                new, conversation.pending = conversation.pending, []
+                response = await self.client.request('get', self.path(account_id, conversation_id))
+                current = list(response['payload'])
+                labels = current + [label for label in new if label not in current]
+                # labels added while reading are written next
+                conversation.labels = labels + [label for label in conversation.pending if label not in labels]
+                conversation.loaded = time.monotonic()
+                if labels == current:
+                    continue
+                await self.side_effects.apply(account_id, conversation_id, 'post', self.path(account_id, conversation_id), {'labels': labels})
+                logger.debug(f'Labeled conversation {conversation_id} of account {account_id} with {labels}')
+        except Exception as e:
+            logger.error(f'Failed to label conversation {conversation_id} of account {account_id}: {e}')
+            # read the labels again next time
+            key = (account_id, conversation_id)
+            if self.conversations.get(key) is conversation:
+                del self.conversations[key]
+        finally:
+            conversation.writing = None
+
+    async def flush(self) -> None:
+        """Wait for the pending writes."""
+        if self.writes:
+            await asyncio.wait(list(self.writes))
+
+    def register(self, app: Any) -> None:
+        """Write pending labels before the server of a Sanic app stops."""
+        async def flush(app, loop) -> None:
+            await self.flush()
+
+        app.register_listener(flush, 'before_server_stop')
+
+# flake8: noqa: E501
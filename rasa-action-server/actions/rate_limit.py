@@ -0,0 +1,127 @@
+# copy of rasa-server/channels/rate_limit.py, which is the canonical version, as the
+# images are built from separate folders; change both
+import asyncio
+import logging
+import time
+from typing import Dict, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+# buckets unused for this many refills from empty at the lowest rate are forgotten,
+# a new bucket would be full as well
+IDLE_REFILLS = 3
+
+
+class RateLimited(Exception):
+    """Raised when a request can't be sent before its deadline."""
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        # no requests before this time, set by Retry-After
+        self.blocked_until = 0.0
+        self.slowed_down = 0.0
+        self.waiting = 0
+        # asyncio locks are fair, so requests get their tokens in order of arrival
+        self.lock = asyncio.Lock()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        self.refill(now)
+        return max(self.blocked_until - now, (1 - self.tokens) / self.rate, 0.0)
+
+
+class AccountRateLimiter:
+    """Token buckets limiting the requests sent to Chatwoot for each account.
+
+    The rate of an account adapts to Chatwoot: a 429 answer halves it, at most
+    once a second and down to `min_rate`, and blocks the account for the time
+    given by Retry-After. Each successful request raises it again by a twentieth
+    of `max_rate`. Requests waiting for a token, including the ones retried
+    after a 429, queue up in order of arrival. A request fails with
+    `RateLimited` when it would get its token after its deadline, or when
+    `max_waiting` requests of its account are waiting already. The buckets of
+    accounts without requests for a while are dropped.
+    """
+
+    def __init__(self, max_rate: float, burst: float, min_rate: float = 0.5, max_waiting: int = 1000) -> None:
+        self.max_rate = max_rate
+        self.burst = max(1.0, burst)
+        self.min_rate = min(min_rate, max_rate)
+        self.max_waiting = max_waiting
+        self.buckets: Dict[Hashable, TokenBucket] = {}
+        self.idle_seconds = IDLE_REFILLS * self.burst / self.min_rate
+        self.swept = time.monotonic()
+
+    def bucket(self, account_id: Hashable) -> TokenBucket:
+        bucket = self.buckets.get(account_id)
+        if bucket is None:
+            self._remove_idle(time.monotonic())
+            bucket = self.buckets[account_id] = TokenBucket(self.max_rate, self.burst)
+        return bucket
+
+    def _remove_idle(self, now: float) -> None:
+        if now - self.swept < self.idle_seconds:
+            return
+        self.swept = now
+        for account_id, bucket in list(self.buckets.items()):
+            if not bucket.waiting and bucket.blocked_until <= now and now - bucket.updated >= self.idle_seconds:
+                del self.buckets[account_id]
+
+    async def acquire(self, account_id: Hashable, deadline: float) -> None:
+        """Wait for a token of the account, `deadline` is a `time.monotonic()` time."""
+        bucket = self.bucket(account_id)
+        if bucket.waiting >= self.max_waiting:
+            raise RateLimited(f"{bucket.waiting} requests of account {account_id} are waiting already")
+        bucket.waiting += 1
+        try:
+            async with bucket.lock:
+                while True:
+                    now = time.monotonic()
+                    wait = bucket.wait_time(now)
+                    if wait <= 0:
+                        bucket.tokens -= 1
+                        return
+                    if now + wait > deadline:
+                        raise RateLimited(f"No request to account {account_id} possible for {wait:.1f}s")
+                    # the rate or the block may change while sleeping, so check again
+                    await asyncio.sleep(wait)
+        finally:
+            bucket.waiting -= 1
+
+    def throttled(self, account_id: Hashable, retry_after: Optional[float] = None) -> None:
+        """Chatwoot answered 429 to a request of the account."""
+        bucket = self.bucket(account_id)
+        now = time.monotonic()
+        bucket.refill(now)
+        # the requests in flight are answered with 429 as well, which slows down once
+        if now - bucket.slowed_down >= 1:
+            bucket.rate = max(self.min_rate, bucket.rate / 2)
+            bucket.slowed_down = now
+            logger.warning(f"Chatwoot is rate limiting account {account_id}, slowing down to {bucket.rate:.1f} requests/s")
+        bucket.tokens = min(bucket.tokens, 0.0)
+        if retry_after:
+            bucket.blocked_until = max(bucket.blocked_until, now + retry_after)
+
+    def succeeded(self, account_id: Hashable) -> None:
+        bucket = self.bucket(account_id)
+        if bucket.rate < self.max_rate:
+            bucket.refill(time.monotonic())
+            bucket.rate = min(self.max_rate, bucket.rate + self.max_rate / 20)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds of a Retry-After header, HTTP dates are not supported."""
+    try:
+        return max(0.0, float(value)) if value else None
+    except ValueError:
+        return None
+
+# flake8: noqa: E501
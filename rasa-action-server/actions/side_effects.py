@@ -0,0 +1,224 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import aiohttp
+
+from actions.chatwoot_client import ChatwootClient
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS operations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    account_id TEXT NOT NULL,
+    conversation_id TEXT NOT NULL,
+    method TEXT NOT NULL,
+    path TEXT NOT NULL,
+    payload TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL DEFAULT 0,
+    claimed_until REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS operations_conversation ON operations (account_id, conversation_id, id);
+"""
+# the first operation of each conversation, the others wait for it
+HEADS = """
+SELECT id, account_id, conversation_id, method, path, payload, attempts, next_attempt, claimed_until
+FROM operations WHERE id IN (SELECT MIN(id) FROM operations GROUP BY account_id, conversation_id) ORDER BY id
+"""
+# look for operations spooled by other processes and expired claims this often
+POLL_SECONDS = 5
+
+
+def is_retryable(e: Exception) -> bool:
+    # Chatwoot rejected the operation itself, e.g. because the conversation is gone
+    if isinstance(e, aiohttp.ClientResponseError) and 400 <= e.status < 500 and e.status != 429:
+        return False
+    return True
+
+
+class SideEffects:
+    """Chatwoot operations of actions which don't change the events the action returns.
+
+    Without a `spool_path` operations are applied right away. With a spool,
+    they are stored in a SQLite database and the action returns without waiting
+    for Chatwoot. Up to `workers` operations are applied in the background, one
+    at a time and in order within a conversation. Failed operations are tried
+    again with exponential backoff up to `attempts` times, operations Chatwoot
+    rejects with a 4xx status are dropped. Operations are applied at least once:
+    after a restart, the operations left in the spool are applied, so they have
+    to be idempotent, like setting the status or the labels of a conversation.
+
+    Worker processes may share the spool, an operation is claimed for
+    `lease_seconds` by the process applying it. The spool is only used from a
+    thread of its own, as sqlite calls block while another process writes.
+    """
+
+    def __init__(
+        self,
+        client: ChatwootClient,
+        spool_path: Optional[str] = None,
+        workers: int = 8,
+        attempts: int = 10,
+        backoff_seconds: float = 1,
+        max_backoff_seconds: float = 300,
+        lease_seconds: float = 120,
+    ) -> None:
+        self.client = client
+        self.spool_path = spool_path
+        self.workers = workers
+        self.attempts = max(1, attempts)
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.lease_seconds = lease_seconds
+        self.db: Optional[sqlite3.Connection] = None
+        self.spool_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix='side-effects-spool')
+        # conversation -> id of the operation being applied
+        self.active: Dict[Tuple[str, str], int] = {}
+        self.tasks: Set[asyncio.Future] = set()
+        # created in the event loop of the server
+        self.wakeup: Optional[asyncio.Event] = None
+        self.dispatcher: Optional[asyncio.Future] = None
+
+    def _spool(self) -> sqlite3.Connection:
+        if self.db is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.spool_path)), exist_ok=True)
+            # autocommit, every statement is a transaction of its own
+            self.db = sqlite3.connect(self.spool_path, isolation_level=None)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            # in WAL mode, commits survive a crash of the process but not of the machine
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute('PRAGMA busy_timeout=5000')
+            self.db.executescript(SCHEMA)
+        return self.db
+
+    async def _spooled(self, function: Callable[..., Any], *args: Any) -> Any:
+        """The result of `function(db, *args)`, called with the spool database in the spool thread."""
+        return await asyncio.get_event_loop().run_in_executor(self.spool_thread, lambda: function(self._spool(), *args))
+
+    async def apply(self, account_id: Any, conversation_id: Any, method: str, path: str, payload: Optional[Dict] = None) -> None:
+        """Apply an idempotent operation on a conversation, in the background with a spool."""
+        if not self.spool_path:
+            await self.client.request(method, path, payload)
+            return
+        await self._spooled(lambda db: db.execute(
+            'INSERT INTO operations (account_id, conversation_id, method, path, payload) VALUES (?, ?, ?, ?, ?)',
+            (str(account_id), str(conversation_id), method, path, json.dumps(payload)),
+        ))
+        self.start()
+        self.wakeup.set()
+
+    def start(self) -> None:
+        if self.spool_path and (self.dispatcher is None or self.dispatcher.done()):
+            self.wakeup = asyncio.Event()
+            self.dispatcher = asyncio.ensure_future(self._dispatch())
+
+    async def _dispatch(self) -> None:
+        while True:
+            self.wakeup.clear()
+            now = time.time()
+            next_check = now + POLL_SECONDS
+            try:
+                next_check = await self._start_ready(now, next_check)
+            except sqlite3.Error as e:
+                logger.error(f'Failed to read the side effects spool: {e}')
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), max(0.01, next_check - time.time()))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _start_ready(self, now: float, next_check: float) -> float:
+        """Start applying the operations which are due, returns when to check again."""
+        due = []
+        for row in await self._spooled(lambda db: db.execute(HEADS).fetchall()):
+            if len(self.tasks) + len(due) >= self.workers:
+                break
+            _, account_id, conversation_id, _, _, _, _, next_attempt, claimed_until = row
+            if (account_id, conversation_id) in self.active:
+                continue
+            ready = max(next_attempt, claimed_until)
+            if ready > now:
+                next_check = min(next_check, ready)
+                continue
+            due.append(row)
+        claimed = await self._spooled(self._claim, [row[0] for row in due], now)
+        for row in due:
+            operation_id, account_id, conversation_id = row[:3]
+            if operation_id not in claimed:
+                continue
+            conversation = (account_id, conversation_id)
+            self.active[conversation] = operation_id
+            task = asyncio.ensure_future(self._apply(row))
+            self.tasks.add(task)
+            task.add_done_callback(lambda task, conversation=conversation: self._applied(task, conversation))
+        return next_check
+
+    def _claim(self, db: sqlite3.Connection, operation_ids: List[int], now: float) -> Set[int]:
+        """Claim operations for this process, returns the ids no other process claimed first."""
+        return {
+            operation_id for operation_id in operation_ids
+            if db.execute(
+                'UPDATE operations SET claimed_until = ? WHERE id = ? AND claimed_until <= ?',
+                (now + self.lease_seconds, operation_id, now),
+            ).rowcount
+        }
+
+    def _applied(self, task: asyncio.Future, conversation: Tuple[str, str]) -> None:
+        self.tasks.discard(task)
+        self.active.pop(conversation, None)
+        self.wakeup.set()
+
+    async def _apply(self, row: Tuple) -> None:
+        operation_id, account_id, conversation_id, method, path, payload, attempts, _, _ = row
+        try:
+            await self.client.request(method, path, json.loads(payload))
+        except Exception as e:
+            attempts += 1
+            if not is_retryable(e) or attempts >= self.attempts:
+                logger.error(f'Dropped chatwoot {method} {path} of conversation {conversation_id} after {attempts} attempts: {e}')
+                await self._spooled(lambda db: db.execute('DELETE FROM operations WHERE id = ?', (operation_id,)))
+                return
+            delay = min(self.max_backoff_seconds, self.backoff_seconds * 2 ** attempts) * random.uniform(0.5, 1)
+            logger.warning(f'Chatwoot {method} {path} of conversation {conversation_id} failed ({e}), retrying in {delay:.1f}s')
+            await self._spooled(lambda db: db.execute(
+                'UPDATE operations SET attempts = ?, next_attempt = ?, claimed_until = 0 WHERE id = ?',
+                (attempts, time.time() + delay, operation_id),
+            ))
+            return
+        await self._spooled(lambda db: db.execute('DELETE FROM operations WHERE id = ?', (operation_id,)))
+
+    async def stop(self, timeout: float) -> None:
+        """Wait up to `timeout` seconds for the operations being applied, the others stay in the spool."""
+        if self.dispatcher is None:
+            return
+        self.dispatcher.cancel()
+        if self.tasks:
+            _, not_done = await asyncio.wait(list(self.tasks), timeout=timeout)
+            for task in not_done:
+                task.cancel()
+        # interrupted operations are applied again on the next start
+        interrupted = [(operation_id,) for operation_id in self.active.values()]
+        await self._spooled(lambda db: db.executemany('UPDATE operations SET claimed_until = 0 WHERE id = ?', interrupted))
+        pending = await self._spooled(lambda db: db.execute('SELECT COUNT(*) FROM operations').fetchone()[0])
+        if pending:
+            logger.info(f'{pending} chatwoot operations left in the side effects spool')
+
+    def register(self, app: Any) -> None:
+        """Apply spooled operations while the server of a Sanic app runs."""
+        async def start(app, loop) -> None:
+            self.start()
+
+        async def stop(app, loop) -> None:
+            await self.stop(10)
+
+        app.register_listener(start, 'before_server_start')
+        app.register_listener(stop, 'before_server_stop')
+
+# flake8: noqa: E501
@@ -1,17 +1,38 @@
-from flask import Flask, render_template, send_from_directory, abort, request, jsonify
+from flask import Flask, Response, render_template, abort, request, jsonify
+import base64
+import json
+import mimetypes
 import os
+import re
+import struct
 from functools import wraps
+from werkzeug.http import http_date
 from werkzeug.utils import secure_filename
-from config import models_dir, server_port
-from filesystem import Scaner
+from werkzeug.wsgi import wrap_file
+from config import models_dir, server_port, rescan_seconds, keep_last, gc_seconds, upload_expiry_seconds
+from chunking import delta
+from filesystem import CHUNK_SIZE, SORT_KEYS, DirectoryIndex, find_fingerprint, fingerprint
+from store import ModelStore
+from uploads import ChecksumMismatch, UploadSessions, receive
 
 ALLOWED_EXTENSIONS = {'tar.gz'}
+SHA256_PATTERN = re.compile(r'[0-9a-f]{64}')
+MAX_PAGE_SIZE = 1000
+# clients wait this long before asking again for a delta whose models are being indexed
+DELTA_RETRY_SECONDS = 5
 API_KEY = os.environ.get('API_KEY', None)
 API_KEY_HEADER = "API-KEY"
 DEBUG = os.environ.get('DEBUG', "0")
 
 app = Flask(__name__)
-app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_REQUEST_SIZE_MB', 64)) * 1000 * 1000
+# uploads are streamed to disk, so this only limits the size of a model, not memory use
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_REQUEST_SIZE_MB', 4096)) * 1000 * 1000
+
+models_index = DirectoryIndex(models_dir, rescan_seconds)
+models_index.watch()
+upload_sessions = UploadSessions(models_dir)
+model_store = ModelStore(models_dir, keep_last)
+model_store.collect_garbage_periodically(gc_seconds, upload_expiry_seconds)
 
 
 def require_apikey(view_function):
@@ -38,32 +59,193 @@ def index():
 
 @app.route('/<path:path>', methods=['GET'])
 def serve(path):
-    fetch_latest = '@latest' in path
-    real_path = os.path.join(models_dir, path.replace('@latest', ''))
+    real_path, error = resolve_path(path)
+    if error:
+        return error
+    if os.path.isdir(real_path):
+        return list_dir(real_path)
+    return download_file(real_path)
+
+
+def resolve_path(path):
+    """Resolve a requested path, like `bot/model.tar.gz` or `bot@latest`, to a model file or a folder.
+
+    Returns the path and None, or None and an error response.
+    """
+    alias = ''
+    if '@' in path and not os.path.exists(os.path.join(models_dir, path)):
+        path, _, alias = path.rpartition('@')
+    if any(part.startswith('.') for part in path.split('/')):
+        # hidden files, like uploads in progress, are not served
+        return None, ('Not Found', 404)
+    real_path = os.path.join(models_dir, path)
     if not os.path.exists(real_path):
-        return 'Not Found', 404
+        return None, ('Not Found', 404)
+    if not alias or not os.path.isdir(real_path):
+        return real_path, None
+
+    # aliases and tags are resolved from the manifest of the store
+    name = store_name(path)
+    stored_path = model_store.resolve(name, alias)
+    if stored_path and os.path.exists(stored_path):
+        return stored_path, None
+    elif alias == 'latest':
+        # the newest of the last upload and the files put into the folder otherwise, e.g. by training
+        latest_entry = models_index.directory(real_path).latest_entry
+        uploaded = model_store.latest_upload(name)
+        if uploaded and os.path.exists(uploaded[0]) and (not latest_entry or uploaded[1] >= latest_entry.mtime):
+            return uploaded[0], None
+        if not latest_entry:
+            return None, ('No Models Found', 404)
+        print('latest_entry', latest_entry.path, flush=True)
+        return latest_entry.path, None
+    return None, ('Not Found', 404)
 
-    if os.path.isdir(real_path):
-        if fetch_latest:
-            latest_entry = Scaner(real_path).latest_entry
-            if not latest_entry:
-                return 'No Models Found', 404
-            print('latest_entry', latest_entry.path, flush=True)
-            return download_file(latest_entry.path)
-        else:
-            return list_dir(real_path)
-    else:
-        return download_file(real_path)
+
+def store_name(path):
+    """Name of the models in a folder of the models folder, '' for the models folder itself."""
+    return '/'.join(secure_filename(part) for part in path.split('/') if part)
 
 
 def list_dir(path):
     rel_path = os.path.relpath(path, models_dir)
     parent_path = os.path.dirname(rel_path)
-    return render_template('index.html', sep=os.sep, parent_path=parent_path, path=rel_path, entries=Scaner(path).entries)
+    return render_template('index.html', sep=os.sep, parent_path=parent_path, path=rel_path, entries=models_index.directory(path).entries)
+
+
+@app.route('/api/models', methods=['GET'])
+@app.route('/api/models/<path:path>', methods=['GET'])
+@require_apikey
+def list_models(path=''):
+    """List a folder of the models folder as json, a page at a time.
+
+    Query parameters: `sort` (name, mtime or size), `order` (asc or desc),
+    `limit`, `prefix` and `tag` filters, and the `cursor` of the previous page.
+    """
+    sort = request.args.get('sort', 'name')
+    descending = request.args.get('order', 'asc') == 'desc'
+    limit = min(max(request.args.get('limit', 100, type=int), 1), MAX_PAGE_SIZE)
+    prefix = request.args.get('prefix', '')
+    tag = request.args.get('tag')
+    if sort not in SORT_KEYS:
+        return {'msg': f'sort has to be one of {", ".join(SORT_KEYS)}'}, 400
+    try:
+        after = decode_cursor(request.args['cursor'], sort) if request.args.get('cursor') else None
+    except ValueError:
+        return {'msg': 'Invalid cursor'}, 400
+
+    real_path, error = resolve_path(path)
+    if error:
+        return error
+    if not os.path.isdir(real_path):
+        return 'Not Found', 404
+    models = {e['filename']: e for e in model_store.manifest()['models'].get(store_name(path), [])}
+
+    def match(entry):
+        if not entry.name.startswith(prefix):
+            return False
+        return tag is None or tag in models.get(entry.name, {}).get('tags', [])
+
+    entries, last = models_index.directory(real_path).page(sort, descending, after, limit, match)
+    return {
+        'path': os.path.relpath(real_path, models_dir),
+        'entries': [entry_json(entry, models.get(entry.name)) for entry in entries],
+        'next_cursor': encode_cursor(sort, last) if last else None,
+    }
+
+
+def entry_json(entry, model=None):
+    result = {
+        'name': entry.name,
+        'path': entry.rel_path,
+        'is_dir': entry.is_dir,
+        'size': entry.size_bytes,
+        'modified': entry.mtime,
+        'created': entry.ctime,
+    }
+    if model:
+        result.update(sha256=model['sha256'], trained_at=model['trained_at'], tags=model['tags'])
+    return result
+
+
+def encode_cursor(sort, key):
+    return base64.urlsafe_b64encode(json.dumps([sort, *key]).encode()).decode()
+
+
+def decode_cursor(cursor, sort):
+    """The sort key of the last entry of the previous page, which has to be sorted the same way."""
+    try:
+        cursor_sort, value, name = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (TypeError, ValueError, UnicodeDecodeError) as e:
+        raise ValueError(cursor) from e
+    if cursor_sort != sort or not isinstance(name, str) or isinstance(value, str) != (sort == 'name'):
+        raise ValueError(cursor)
+    return value, name
 
 
 def download_file(path):
-    return send_from_directory(os.path.dirname(path), os.path.basename(path), as_attachment=True)
+    # Rasa sends the ETag of its current model as If-None-Match when polling,
+    # unchanged models are answered without touching the file
+    etag = fingerprint(path)
+    if request.if_none_match.contains(etag):
+        return '', 304, {'ETag': f'"{etag}"'}
+    return send_model(path, etag)
+
+
+def send_model(path, etag):
+    """Send a model file, or the byte range of it asked for with `Range`.
+
+    The whole file goes to the WSGI server's file wrapper, gunicorn sends it with
+    sendfile straight from the page cache. Ranges are read in blocks and stop at
+    the end of the range, as not every server limits a body to its Content-Length.
+    """
+    fp = open(path, 'rb')
+    st = os.fstat(fp.fileno())
+    headers = {
+        'ETag': f'"{etag}"',
+        'Last-Modified': http_date(st.st_mtime),
+        'Accept-Ranges': 'bytes',
+        'Content-Disposition': f'attachment; filename={os.path.basename(path)}',
+    }
+    start, length, status = 0, st.st_size, 200
+    byte_range = request.range
+    if byte_range and len(byte_range.ranges) == 1 and range_is_current(etag, st.st_mtime):
+        bounds = byte_range.range_for_length(st.st_size)
+        if bounds is None:
+            fp.close()
+            return '', 416, dict(headers, **{'Content-Range': f'bytes */{st.st_size}'})
+        start, stop = bounds
+        length, status = stop - start, 206
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{st.st_size}'
+        fp.seek(start)
+
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    body = read_range(fp, length) if status == 206 else wrap_file(request.environ, fp)
+    response = Response(body, status=status, headers=headers, mimetype=mimetype, direct_passthrough=True)
+    response.content_length = length
+    # HEAD responses never iterate the file wrapper
+    response.call_on_close(fp.close)
+    return response
+
+
+def read_range(fp, length, block_size=1024 * 1024):
+    """Yield the next `length` bytes of a file."""
+    while length > 0:
+        block = fp.read(min(block_size, length))
+        if not block:
+            return
+        length -= len(block)
+        yield block
+
+
+def range_is_current(etag, mtime):
+    """Check `If-Range`, a range of a model which changed since is answered with the whole model."""
+    if_range = request.if_range
+    if if_range.etag:
+        return if_range.etag == etag
+    if if_range.date:
+        return int(if_range.date.timestamp()) == int(mtime)
+    return True
 
 
 @app.errorhandler(401)
@@ -71,18 +253,153 @@ def server_error(e):
     return jsonify(error=str(e)), 401
 
 
+def expected_sha256():
+    """The SHA-256 of the upload given by the client, if any."""
+    return request.headers.get('X-Checksum-SHA256') or request.args.get('sha256')
+
+
+def store_upload(tmp_path, filename, sha256):
+    """Add an upload to the model store, under the `name` and with the `tags` of the request."""
+    name = store_name(request.args.get('name', ''))
+    tags = [tag for tag in request.args.get('tags', '').split(',') if tag]
+    entry = model_store.add(tmp_path, name, filename, sha256, tags, request.args.get('trained_at', type=float))
+    models_index.invalidate(os.path.join(models_dir, name))
+    # index the chunks of the new model ahead of the first delta download
+    path = model_store.model_path(name, filename)
+    model_store.start_indexing(path, sha256)
+    return dict(entry, msg='File uploaded successfully', name=name)
+
+
+@app.route('/delta/<path:path>', methods=['GET'])
+def serve_delta(path):
+    """Send a model as the changes to a base model the client has, identified by its SHA-256 in `base`.
+
+    The response is the length of a json header as 8 byte big-endian integer, the
+    header with the SHA-256, size and operations building the model, and the data
+    of the `data` operations. `fetch_model.py` downloads and reassembles models.
+    """
+    base = request.args.get('base', '').lower()
+    real_path, error = resolve_path(path)
+    if error:
+        return error
+    if os.path.isdir(real_path):
+        return 'Not Found', 404
+    base_path = find_model(base) if SHA256_PATTERN.fullmatch(base) else None
+    if base_path is None:
+        # the client downloads the whole model instead
+        return 'Unknown base model', 404
+
+    # the chunks are indexed in another process, the client asks again or downloads the whole model
+    target_index = model_store.chunk_index(real_path, fingerprint(real_path))
+    base_index = model_store.chunk_index(base_path, base)
+    if target_index is None or base_index is None:
+        return 'Indexing the models, try again later', 202, {'Retry-After': str(DELTA_RETRY_SECONDS)}
+    ops = delta(base_index, target_index)
+    header = json.dumps({'sha256': target_index['sha256'], 'size': target_index['size'], 'base': base, 'ops': ops}).encode()
+
+    def generate():
+        yield struct.pack('>Q', len(header)) + header
+        with open(real_path, 'rb') as fp:
+            for op, offset, length in ops:
+                if op != 'data':
+                    continue
+                fp.seek(offset)
+                while length:
+                    data = fp.read(min(CHUNK_SIZE, length))
+                    length -= len(data)
+                    yield data
+
+    response = Response(generate(), mimetype='application/octet-stream', headers={'ETag': f'"{target_index["sha256"]}"'})
+    response.content_length = 8 + len(header) + sum(length for op, _, length in ops if op == 'data')
+    return response
+
+
+def find_model(sha256):
+    """Path of a model with the given SHA-256, from the store or from the models served so far."""
+    blob = model_store.blob_path(sha256)
+    if os.path.exists(blob):
+        return blob
+    return find_fingerprint(sha256)
+
+
 @app.route('/upload/<filename>', methods=['POST'])
 @require_apikey
 def upload_model(filename):
     if filename and allowed_file(filename):
         filename = secure_filename(filename)
-        with open(os.path.join(models_dir, filename), "wb") as fp:
-            fp.write(request.data)
-        result = {'msg': 'File uploaded successfully'}
-        return result, 201
+        try:
+            tmp_path, sha256 = receive(request.stream, models_dir, expected_sha256())
+        except ChecksumMismatch as e:
+            return {'msg': str(e)}, 400
+        return store_upload(tmp_path, filename, sha256), 201
     return {'msg': 'No file or file extension not allowed'}, 400
 
 
+@app.route('/uploads/<filename>', methods=['POST'])
+@require_apikey
+def create_upload_session(filename):
+    if filename and allowed_file(filename):
+        session = upload_sessions.create(secure_filename(filename))
+        return session.to_dict(), 201
+    return {'msg': 'No file or file extension not allowed'}, 400
+
+
+@app.route('/uploads/<session_id>', methods=['GET', 'PUT', 'DELETE'])
+@require_apikey
+def upload_session(session_id):
+    session = upload_sessions.get(session_id)
+    if session is None:
+        return {'msg': 'No such upload'}, 404
+    if request.method == 'PUT':
+        offset = request.args.get('offset', type=int)
+        if offset is None or not upload_sessions.append(session, offset, request.stream):
+            return dict(session.to_dict(), msg='Chunks have to be sent at the offset of the received data'), 409
+    elif request.method == 'DELETE':
+        upload_sessions.abort(session)
+        return {'msg': 'Upload aborted'}
+    return session.to_dict()
+
+
+@app.route('/uploads/<session_id>/complete', methods=['POST'])
+@require_apikey
+def complete_upload_session(session_id):
+    session = upload_sessions.get(session_id)
+    if session is None:
+        return {'msg': 'No such upload'}, 404
+    try:
+        tmp_path, sha256 = upload_sessions.complete(session, expected_sha256())
+    except ChecksumMismatch as e:
+        return {'msg': str(e)}, 400
+    return store_upload(tmp_path, session.filename, sha256), 201
+
+
+@app.route('/aliases/<alias>', methods=['PUT'])
+@require_apikey
+def set_alias(alias):
+    """Point an alias like `latest` of a name to one of its models, e.g. to roll back."""
+    body = request.get_json(silent=True) or {}
+    name = store_name(body.get('name', ''))
+    if not body.get('filename') or not model_store.set_alias(name, alias, body['filename']):
+        return {'msg': 'No such model'}, 404
+    return {'name': name, 'alias': alias, 'filename': body['filename']}
+
+
+@app.route('/aliases/<alias>', methods=['DELETE'])
+@require_apikey
+def remove_alias(alias):
+    """Remove an alias, e.g. so that `latest` follows new models again after a roll back."""
+    name = store_name(request.args.get('name', ''))
+    if not model_store.remove_alias(name, alias):
+        return {'msg': 'No such alias'}, 404
+    return {'name': name, 'alias': alias}
+
+
+@app.route('/manifest', methods=['GET'])
+@require_apikey
+def manifest():
+    return model_store.manifest()
+
+
 def allowed_file(filename):
     return '.' in filename and \
            filename.split('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -0,0 +1,135 @@
+import fcntl
+import hashlib
+import json
+import os
+import random
+import sys
+
+import numpy as np
+
+# content defined chunking: a chunk ends where the hash of the last WINDOW bytes
+# has its top bits cleared, so an insertion or deletion only changes the chunks
+# around it and the following chunks are found again. The hash is the sum of a
+# random value per byte over the window, so the hashes of a whole buffer come
+# from a single cumulative sum in numpy instead of a loop over the bytes.
+WINDOW = 64
+MIN_CHUNK_SIZE = 16 * 1024
+# 16 bits give chunks of 64 KB on average
+CUT_MASK = np.uint32(0xFFFF << 16)
+MAX_CHUNK_SIZE = 256 * 1024
+READ_SIZE = 1024 * 1024
+# fixed seed, chunk boundaries have to be the same for all servers
+GEAR = np.array([random.Random(f'gear-{i}').getrandbits(32) for i in range(256)], dtype=np.uint32)
+# indexes of an earlier chunking are computed again
+INDEX_VERSION = 2
+
+
+def _candidates(fp):
+    """End offsets of the chunks the content allows, and the size of the file."""
+    found = []
+    # the last bytes of the previous buffer, the first windows of the next one start in them
+    tail = np.zeros(0, dtype=np.uint8)
+    offset = 0
+    for data in iter(lambda: fp.read(READ_SIZE), b''):
+        buf = np.concatenate((tail, np.frombuffer(data, dtype=np.uint8)))
+        # sums wrap around, the differences are still the sums of the windows
+        sums = np.cumsum(GEAR[buf], dtype=np.uint32)
+        hashes = sums[WINDOW - 1:].copy()
+        hashes[1:] -= sums[:-WINDOW]
+        found.append(np.flatnonzero((hashes & CUT_MASK) == 0) + (offset + WINDOW))
+        tail = buf[-(WINDOW - 1):]
+        offset += len(buf) - len(tail)
+    return np.concatenate(found) if found else np.zeros(0, dtype=np.int64), offset + len(tail)
+
+
+def _cut_points(candidates, size):
+    """Yield the end offsets of the chunks, at the first candidate past `MIN_CHUNK_SIZE` or at `MAX_CHUNK_SIZE`."""
+    start = 0
+    while start < size:
+        i = np.searchsorted(candidates, start + MIN_CHUNK_SIZE)
+        end = int(candidates[i]) if i < len(candidates) else size
+        start = min(end, start + MAX_CHUNK_SIZE, size)
+        yield start
+
+
+def chunks(fp):
+    """Yield `(offset, length, digest)` of the content defined chunks of a file."""
+    candidates, size = _candidates(fp)
+    fp.seek(0)
+    offset = 0
+    for end in _cut_points(candidates, size):
+        yield offset, end - offset, hashlib.blake2b(fp.read(end - offset), digest_size=16).hexdigest()
+        offset = end
+
+
+def index_path(index_dir, sha256):
+    return os.path.join(index_dir, f'{sha256}.v{INDEX_VERSION}.json')
+
+
+def load_index(index_dir, sha256):
+    """The chunks of a file with the given SHA-256 from `index_dir`, or None if it isn't indexed yet."""
+    try:
+        with open(index_path(index_dir, sha256)) as fp:
+            return json.load(fp)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _lock_file(index_dir, sha256):
+    os.makedirs(index_dir, exist_ok=True)
+    return open(os.path.join(index_dir, f'{sha256}.lock'), 'a')
+
+
+def indexing(index_dir, sha256):
+    """Whether a process is indexing the file with the given SHA-256."""
+    with _lock_file(index_dir, sha256) as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+    return False
+
+
+def chunk_index(path, sha256, index_dir):
+    """The chunks of a file with the given SHA-256, computed once and kept in `index_dir`."""
+    with _lock_file(index_dir, sha256) as lock_file:
+        # concurrent processes wait for a single indexing of the file
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        index = load_index(index_dir, sha256)
+        if index is not None:
+            return index
+        with open(path, 'rb') as fp:
+            index = {'sha256': sha256, 'size': os.fstat(fp.fileno()).st_size, 'chunks': list(chunks(fp))}
+        tmp_path = f'{index_path(index_dir, sha256)}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as fp:
+            json.dump(index, fp)
+        os.replace(tmp_path, index_path(index_dir, sha256))
+        return index
+
+
+def delta(base_index, target_index):
+    """Operations building the target from the base: `["copy", base_offset, length]` or `["data", target_offset, length]`.
+
+    Consecutive operations are merged, so unchanged parts become a single copy.
+    """
+    base_chunks = {digest: offset for offset, _, digest in base_index['chunks']}
+    ops = []
+    for offset, length, digest in target_index['chunks']:
+        if digest in base_chunks:
+            op = ['copy', base_chunks[digest], length]
+        else:
+            op = ['data', offset, length]
+        last = ops[-1] if ops else None
+        if last and last[0] == op[0] and last[1] + last[2] == op[1]:
+            last[2] += length
+        else:
+            ops.append(op)
+    return ops
+
+
+if __name__ == '__main__':
+    # python chunking.py <path> <sha256> <index_dir>, the server indexes models in a process of its own
+    os.nice(10)
+    chunk_index(*sys.argv[1:4])
+
+# flake8: noqa: E501
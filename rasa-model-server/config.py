@@ -1,4 +1,14 @@
 from os import environ
 
 models_dir = environ.get('MODELS_DIR', 'models')
-server_port = environ.get('PORT', 8080)
\ No newline at end of file
+server_port = environ.get('PORT', 8080)
+# seconds after which cached directory listings are scanned again, in case the file watcher missed a change
+rescan_seconds = float(environ.get('MODELS_RESCAN_SECONDS', 300))
+# gunicorn worker processes (default: number of cpus, up to 4) and threads per worker
+workers = int(environ.get('WORKERS', 0))
+threads = int(environ.get('THREADS', 32))
+# models kept for each name in the model store, besides tagged ones and alias targets, 0 keeps all
+keep_last = int(environ.get('MODELS_KEEP_LAST', 10))
+# how often unreferenced model blobs are removed, and when abandoned uploads are
+gc_seconds = float(environ.get('MODELS_GC_SECONDS', 600))
+upload_expiry_seconds = float(environ.get('UPLOAD_EXPIRY_SECONDS', 24 * 3600))
@@ -0,0 +1,125 @@
+"""Download a model from the model server, as a delta to a model you already have.
+
+    python fetch_model.py http://localhost:8080/bot@latest -o model.tar.gz --base current.tar.gz
+
+Only the chunks of the new model which are not in the base model are downloaded,
+the new model is reassembled from the base model and those chunks, and its
+SHA-256 is verified before it replaces the output file. Without a base model, or
+if the server doesn't know the base model, the whole model is downloaded.
+Deltas are only small for models compressed with `gzip --rsyncable` or not
+compressed at all, see the README.
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import struct
+import sys
+import time
+from urllib.error import HTTPError
+from urllib.parse import urlsplit, urlunsplit, urlencode
+from urllib.request import urlopen
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def delta_url(url, base_sha256):
+    scheme, netloc, path, query, _ = urlsplit(url)
+    query = '&'.join(q for q in (query, urlencode({'base': base_sha256})) if q)
+    return urlunsplit((scheme, netloc, f'/delta{path}', query, ''))
+
+
+def read_exactly(response, length):
+    data = response.read(length)
+    if len(data) != length:
+        raise IOError('Delta download ended early')
+    return data
+
+
+def apply_delta(response, base_path, out):
+    """Write the model described by a delta response to `out`, returns the expected SHA-256."""
+    header_length, = struct.unpack('>Q', read_exactly(response, 8))
+    header = json.loads(read_exactly(response, header_length))
+    copied = downloaded = 0
+    with open(base_path, 'rb') as base:
+        for op, offset, length in header['ops']:
+            if op == 'copy':
+                base.seek(offset)
+                source, copied = base, copied + length
+            else:
+                source, downloaded = response, downloaded + length
+            while length:
+                data = source.read(min(CHUNK_SIZE, length))
+                if not data:
+                    raise IOError('Delta download ended early')
+                out.write(data)
+                length -= len(data)
+    print(f'Reused {copied} bytes of the base model, downloaded {downloaded} bytes', file=sys.stderr)
+    return header['sha256']
+
+
+def open_delta(url, wait_seconds):
+    """The delta response, or None when the server is still indexing the models after `wait_seconds`."""
+    deadline = time.monotonic() + wait_seconds
+    while True:
+        response = urlopen(url)
+        if response.status != 202:
+            return response
+        response.close()
+        retry_after = float(response.headers.get('Retry-After', 5))
+        if time.monotonic() + retry_after > deadline:
+            return None
+        print(f'The server is indexing the models, asking again in {retry_after:.0f}s', file=sys.stderr)
+        time.sleep(retry_after)
+
+
+def fetch(url, output, base_path=None, wait_seconds=60):
+    tmp_path = f'{output}.part'
+    expected = None
+    with open(tmp_path, 'wb') as out:
+        try:
+            if base_path:
+                response = open_delta(delta_url(url, file_sha256(base_path)), wait_seconds)
+                if response is None:
+                    print('Delta not available yet, downloading the whole model', file=sys.stderr)
+                else:
+                    with response:
+                        expected = apply_delta(response, base_path, out)
+        except HTTPError as e:
+            if e.code != 404:
+                raise
+            print(f'Delta not available ({e.reason}), downloading the whole model', file=sys.stderr)
+            out.seek(0)
+            out.truncate()
+        if expected is None:
+            with urlopen(url) as response:
+                shutil.copyfileobj(response, out, CHUNK_SIZE)
+                expected = response.headers.get('ETag', '').strip('"') or None
+
+    sha256 = file_sha256(tmp_path)
+    if expected and sha256 != expected:
+        os.remove(tmp_path)
+        raise SystemExit(f'SHA-256 mismatch: expected {expected}, got {sha256}')
+    os.replace(tmp_path, output)
+    print(sha256)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Download a model, reusing the chunks of a model you already have.')
+    parser.add_argument('url', help='model url, like http://localhost:8080/bot@latest')
+    parser.add_argument('-o', '--output', required=True, help='where to write the model')
+    parser.add_argument('--base', help='a previous version of the model')
+    parser.add_argument('--wait', type=float, default=60, help='seconds to wait for the server to index the models for a delta')
+    args = parser.parse_args()
+    fetch(args.url, args.output, args.base, args.wait)
+
+# flake8: noqa: E501
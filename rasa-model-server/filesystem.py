@@ -1,36 +1,155 @@
+import hashlib
+import json
+import threading
+from bisect import bisect_left, bisect_right
+import time
 from datetime import datetime
-from os import scandir, listdir
-from os.path import isfile, isdir, relpath, join, getsize
+from os import getpid, makedirs, remove, replace, scandir, stat
+from os.path import basename, dirname, abspath, join, relpath
+from stat import S_ISDIR
 
 from config import models_dir
 
+# path -> ((inode, mtime, size), sha256 of the content)
+FINGERPRINTS = {}
+# path -> lock held while the file is hashed, so only requests for the same file wait
+HASHING_LOCKS = {}
+HASHING_LOCKS_LOCK = threading.Lock()
+CHUNK_SIZE = 1024 * 1024
+# fingerprints are shared with the other worker processes, by SHA-256 and by path
+FINGERPRINTS_DIR = join(models_dir, '.store', 'fingerprints')
 
-class Scaner:
-    def __init__(self, path):
-        self.entries = [Entry(entry) for entry in scandir(path.encode())]
-        self.latest_entry = next(iter(sorted(self.entries, key=lambda e: e.modified_time, reverse=True)), None)
+
+def _file_key(path):
+    st = stat(path)
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def _sha256_record(sha256):
+    return join(FINGERPRINTS_DIR, 'sha256', sha256)
+
+
+def _path_record(path):
+    return join(FINGERPRINTS_DIR, 'paths', hashlib.blake2b(abspath(path).encode(), digest_size=16).hexdigest())
+
+
+def _save_fingerprint(path, key, sha256):
+    FINGERPRINTS[path] = (key, sha256)
+    record = json.dumps({'path': abspath(path), 'key': key, 'sha256': sha256})
+    try:
+        for record_path in (_sha256_record(sha256), _path_record(path)):
+            makedirs(dirname(record_path), exist_ok=True)
+            tmp_path = f'{record_path}.{getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'w') as fp:
+                fp.write(record)
+            replace(tmp_path, record_path)
+    except OSError as e:
+        print(f'Failed to save the fingerprint of {path}: {e}', flush=True)
+
+
+def _load_fingerprint(record_path):
+    """The path, file key and SHA-256 of a saved fingerprint, if the file didn't change since."""
+    try:
+        with open(record_path) as fp:
+            record = json.load(fp)
+        if _file_key(record['path']) == tuple(record['key']):
+            return record['path'], tuple(record['key']), record['sha256']
+    except (FileNotFoundError, KeyError, ValueError):
+        pass
+    return None
+
+
+def fingerprint(path):
+    """SHA-256 of the content of a file, computed once and cached until the file changes."""
+    key = _file_key(path)
+    cached = FINGERPRINTS.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+    # concurrent requests for a new model wait for a single hashing of the file
+    with HASHING_LOCKS_LOCK:
+        lock = HASHING_LOCKS.setdefault(path, threading.Lock())
+    try:
+        with lock:
+            cached = FINGERPRINTS.get(path)
+            if cached and cached[0] == key:
+                return cached[1]
+            saved = _load_fingerprint(_path_record(path))
+            if saved and saved[1] == key:
+                FINGERPRINTS[path] = (key, saved[2])
+                return saved[2]
+            digest = hashlib.sha256()
+            with open(path, 'rb') as fp:
+                for chunk in iter(lambda: fp.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+            _save_fingerprint(path, key, digest.hexdigest())
+            return FINGERPRINTS[path][1]
+    finally:
+        # requests arriving later find the fingerprint in the cache
+        with HASHING_LOCKS_LOCK:
+            if HASHING_LOCKS.get(path) is lock and not lock.locked():
+                del HASHING_LOCKS[path]
+
+
+def find_fingerprint(sha256):
+    """Path of a file with the given fingerprint among the files fingerprinted by any worker, or None."""
+    for path, (key, fingerprinted) in list(FINGERPRINTS.items()):
+        if fingerprinted == sha256:
+            try:
+                if _file_key(path) == key:
+                    return path
+            except FileNotFoundError:
+                pass
+    saved = _load_fingerprint(_sha256_record(sha256))
+    return saved[0] if saved else None
+
+
+def remember_fingerprint(path, sha256):
+    """Cache the fingerprint of a file just written, so it isn't read again."""
+    _save_fingerprint(path, _file_key(path), sha256)
+
+
+def remove_stale_fingerprints():
+    """Remove the saved fingerprints of files which changed or are gone, returns how many."""
+    removed = 0
+    for folder in ('sha256', 'paths'):
+        try:
+            with scandir(join(FINGERPRINTS_DIR, folder)) as it:
+                record_paths = [entry.path for entry in it if not entry.name.endswith('.tmp')]
+        except FileNotFoundError:
+            continue
+        for record_path in record_paths:
+            if _load_fingerprint(record_path) is None:
+                try:
+                    remove(record_path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+    return removed
 
 
 class Entry:
-    def __init__(self, entry):
-        self.name = entry.name.decode()
-        self.path = entry.path.decode()
+    def __init__(self, index, path, st, is_dir):
+        self.index = index
+        self.name = basename(path)
+        self.path = path
         self.rel_path = relpath(self.path, models_dir)
-        self.is_dir = entry.is_dir()
-        self.created_time = datetime.fromtimestamp(entry.stat().st_ctime)
-        self.modified_time = datetime.fromtimestamp(entry.stat().st_mtime)
-        self.size = self._human_readable_size(self._get_size(entry.path))
-
-    def _get_size(self, path):
-        total_size = getsize(path)
-        if isdir(path):
-            for item in listdir(path):
-                item_path = join(path, item)
-                if isfile(item_path):
-                    total_size += getsize(item_path)
-                elif isdir(item_path):
-                    total_size += self._get_size(item_path)
-        return total_size
+        self.is_dir = is_dir
+        self.created_time = datetime.fromtimestamp(st.st_ctime)
+        self.modified_time = datetime.fromtimestamp(st.st_mtime)
+        self.mtime = st.st_mtime
+        self.ctime = st.st_ctime
+        self._size = st.st_size
+
+    @property
+    def size_bytes(self):
+        """Size of a file, or of a directory with everything in it."""
+        if self.is_dir:
+            return self.index.directory(self.path).total_size
+        return self._size
+
+    @property
+    def size(self):
+        return self._human_readable_size(self.size_bytes)
 
     def _human_readable_size(self, size):
         units = ['B', 'KB', 'MB', 'GB', 'TB']
@@ -44,4 +163,147 @@ class Entry:
 
         return human_fmt.format(size, units[-1])
 
+
+# orderings of directory entries, ties are broken by name
+SORT_KEYS = {
+    'name': lambda entry: entry.name,
+    'mtime': lambda entry: entry.mtime,
+    'size': lambda entry: entry.size_bytes,
+}
+
+
+class Directory:
+    """One scan of a directory: its entries sorted by name and the newest one."""
+
+    def __init__(self, index, path):
+        self.index = index
+        self.path = path
+        st = stat(path)
+        self.mtime = st.st_mtime_ns
+        self.own_size = st.st_size
+        self.stale = False
+        self._total_size = None
+        # sort key -> (sorted keys, entries in that order)
+        self._sorted = {}
+        entries = []
+        with scandir(path.encode()) as it:
+            for entry in it:
+                if entry.name.startswith(b'.'):
+                    # hidden, like uploads in progress
+                    continue
+                try:
+                    # a single stat per entry, following symlinks like the listing always did
+                    entry_stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append(Entry(index, entry.path.decode(), entry_stat, S_ISDIR(entry_stat.st_mode)))
+        self.entries = sorted(entries, key=lambda e: e.name)
+        self.latest_entry = max(self.entries, key=lambda e: e.modified_time, default=None)
+
+    @property
+    def total_size(self):
+        if self._total_size is None:
+            self._total_size = self.own_size + sum(entry.size_bytes for entry in self.entries)
+        return self._total_size
+
+    def sorted_entries(self, sort):
+        """The entries ordered by a key of `SORT_KEYS`, sorted once per scan."""
+        if sort not in self._sorted:
+            keyed = sorted(((SORT_KEYS[sort](entry), entry.name), entry) for entry in self.entries)
+            self._sorted[sort] = ([key for key, _ in keyed], [entry for _, entry in keyed])
+        return self._sorted[sort]
+
+    def page(self, sort, descending=False, after=None, limit=100, match=None):
+        """Up to `limit` entries following the sort key `after`, returns them and the key of the last one.
+
+        Returns None as key when there are no more entries.
+        """
+        keys, entries = self.sorted_entries(sort)
+        if descending:
+            start = bisect_left(keys, after) - 1 if after else len(keys) - 1
+            positions = range(start, -1, -1)
+        else:
+            start = bisect_right(keys, after) if after else 0
+            positions = range(start, len(keys))
+        page = []
+        for position in positions:
+            if match is None or match(entries[position]):
+                if len(page) == limit:
+                    return page, keys[page_end]
+                page.append(entries[position])
+                page_end = position
+        return page, None
+
+
+class DirectoryIndex:
+    """Directories of the models folder, scanned once and kept until they change.
+
+    A cached directory is scanned again when its mtime changes (entries added,
+    removed or renamed), when the file watcher reports a change in it, or after
+    `rescan_seconds` as a fallback for changes the watcher missed.
+    """
+
+    def __init__(self, root, rescan_seconds):
+        self.root = abspath(root)
+        self.rescan_seconds = rescan_seconds
+        self.dirs = {}
+        self.lock = threading.RLock()
+        self.scanned = time.monotonic()
+        self.observer = None
+
+    def directory(self, path):
+        path = abspath(path)
+        with self.lock:
+            if time.monotonic() >= self.scanned + self.rescan_seconds:
+                self.scanned = time.monotonic()
+                for directory in self.dirs.values():
+                    directory.stale = True
+            directory = self.dirs.get(path)
+            if directory is None or directory.stale or directory.mtime != stat(path).st_mtime_ns:
+                directory = Directory(self, path)
+                self.dirs[path] = directory
+                self._reset_sizes(path)
+            return directory
+
+    def invalidate(self, path):
+        """Scan a directory again on next use, and recompute the sizes of its parents."""
+        path = abspath(path)
+        with self.lock:
+            directory = self.dirs.get(path)
+            if directory:
+                directory.stale = True
+            self._reset_sizes(path)
+
+    def _reset_sizes(self, path):
+        while path != self.root and path.startswith(self.root):
+            path = dirname(path)
+            parent = self.dirs.get(path)
+            if parent:
+                parent._total_size = None
+                parent._sorted.pop('size', None)
+
+    def watch(self):
+        """Invalidate directories as soon as files change, if watchdog is installed."""
+        try:
+            from watchdog.events import FileSystemEventHandler
+            from watchdog.observers import Observer
+        except ImportError:
+            print(f'watchdog is not installed, rescanning models every {self.rescan_seconds}s', flush=True)
+            return
+
+        index = self
+
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                for path in (event.src_path, getattr(event, 'dest_path', None)):
+                    if path:
+                        index.invalidate(dirname(path))
+                        if event.is_directory:
+                            index.invalidate(path)
+
+        self.observer = Observer()
+        self.observer.daemon = True
+        self.observer.schedule(Handler(), self.root, recursive=True)
+        self.observer.start()
+
 # flake8: noqa: E501
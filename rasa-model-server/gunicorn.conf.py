@@ -0,0 +1,16 @@
+import multiprocessing
+
+import config
+
+# production serving, `python app.py` runs the development server instead
+bind = f'0.0.0.0:{config.server_port}'
+# threaded workers, so that slow downloads don't keep other requests waiting
+worker_class = 'gthread'
+workers = config.workers or min(4, multiprocessing.cpu_count())
+threads = config.threads
+# model files are sent with sendfile(2) from the page cache
+sendfile = True
+keepalive = 5
+accesslog = '-'
+
+# flake8: noqa: E501
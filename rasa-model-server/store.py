@@ -0,0 +1,266 @@
+import copy
+import fcntl
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import chunking
+from filesystem import remember_fingerprint, remove_stale_fingerprints
+from uploads import UPLOADS_DIR
+
+# blobs and the manifest are kept in this hidden folder of the models folder
+STORE_DIR = '.store'
+# rasa names trained models like 20230103-123456-brave-fox.tar.gz
+RASA_MODEL_TIMESTAMP = re.compile(r'^(\d{8}-\d{6})')
+
+
+def trained_at(filename, default=None):
+    """Training time of a model from its rasa filename, or `default`."""
+    match = RASA_MODEL_TIMESTAMP.match(filename)
+    if match:
+        try:
+            return datetime.strptime(match.group(1), '%Y%m%d-%H%M%S').timestamp()
+        except ValueError:
+            pass
+    return default if default is not None else time.time()
+
+
+class ModelStore:
+    """Content addressed storage of uploaded models.
+
+    Every distinct model is stored once, as a blob named by its SHA-256. The
+    manifest records the models uploaded under each name (a folder of the models
+    folder) with their hash, size, training time and tags, and the aliases of a
+    name set explicitly, like `latest` to roll back. Models are published as hard
+    links to their blob at `<name>/<filename>`, so they are served and listed like
+    any other file.
+
+    For each name the newest `keep_last` models are kept, together with tagged
+    models, the last upload and the targets of aliases. Blobs no model refers to anymore are
+    removed by `collect_garbage`. Changes are serialized with a lock file, so
+    all worker processes can share the store.
+    """
+
+    def __init__(self, models_dir, keep_last):
+        self.models_dir = models_dir
+        self.keep_last = keep_last
+        self.store_dir = os.path.join(models_dir, STORE_DIR)
+        self.blobs_dir = os.path.join(self.store_dir, 'blobs')
+        self.manifest_path = os.path.join(self.store_dir, 'manifest.json')
+        self.chunks_dir = os.path.join(self.store_dir, 'chunks')
+        self.lock = threading.Lock()
+        self.cached = (None, None)
+
+    @contextmanager
+    def locked(self):
+        os.makedirs(self.store_dir, exist_ok=True)
+        with self.lock, open(os.path.join(self.store_dir, 'manifest.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def manifest(self):
+        """The current manifest, read again only when another process changed it."""
+        try:
+            st = os.stat(self.manifest_path)
+        except FileNotFoundError:
+            return {'models': {}, 'aliases': {}}
+        key = (st.st_ino, st.st_mtime_ns)
+        if self.cached[0] != key:
+            with open(self.manifest_path) as fp:
+                self.cached = (key, json.load(fp))
+        return self.cached[1]
+
+    def _write_manifest(self, manifest):
+        tmp_path = f'{self.manifest_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as fp:
+            json.dump(manifest, fp, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def blob_path(self, sha256):
+        return os.path.join(self.blobs_dir, sha256[:2], sha256)
+
+    def chunk_index(self, path, sha256):
+        """The chunks of a model for delta downloads, or None while they are indexed in the background."""
+        index = chunking.load_index(self.chunks_dir, sha256)
+        if index is None:
+            self.start_indexing(path, sha256)
+            return None
+        # recently used indexes of models outside of the store are kept by `collect_garbage`
+        os.utime(chunking.index_path(self.chunks_dir, sha256))
+        return index
+
+    def start_indexing(self, path, sha256):
+        """Index the chunks of a model in a separate process, unless one is indexing it already."""
+        if chunking.indexing(self.chunks_dir, sha256):
+            return
+        process = subprocess.Popen([sys.executable, os.path.abspath(chunking.__file__), path, sha256, self.chunks_dir])
+        # collect the exit status, so the process doesn't linger as a zombie
+        threading.Thread(target=process.wait, daemon=True).start()
+
+    def model_path(self, name, filename):
+        return os.path.join(self.models_dir, name, filename)
+
+    def add(self, tmp_path, name, filename, sha256, tags=(), trained=None):
+        """Store an uploaded file and publish it as a model of `name`.
+
+        The temporary file is moved into the store, or dropped if the same
+        content is stored already. Returns the manifest entry of the model.
+        """
+        with self.locked():
+            blob = self.blob_path(sha256)
+            if os.path.exists(blob):
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                os.replace(tmp_path, blob)
+            path = self.model_path(name, filename)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            link_tmp = f'{blob}.{os.getpid()}.{threading.get_ident()}.link'
+            os.link(blob, link_tmp)
+            os.replace(link_tmp, path)
+            remember_fingerprint(path, sha256)
+
+            manifest = copy.deepcopy(self.manifest())
+            entries = [e for e in manifest['models'].get(name, []) if e['filename'] != filename]
+            entry = {
+                'filename': filename,
+                'sha256': sha256,
+                'size': os.path.getsize(blob),
+                'trained_at': trained_at(filename, trained),
+                'uploaded_at': time.time(),
+                'tags': sorted(set(tags)),
+            }
+            entries.append(entry)
+            manifest['models'][name] = entries
+            self._apply_retention(manifest, name)
+            self._write_manifest(manifest)
+        return entry
+
+    def set_alias(self, name, alias, filename):
+        """Point an alias, like `latest`, of a name to one of its models. Returns False for unknown models."""
+        with self.locked():
+            manifest = copy.deepcopy(self.manifest())
+            if not any(e['filename'] == filename for e in manifest['models'].get(name, [])):
+                return False
+            manifest['aliases'].setdefault(name, {})[alias] = filename
+            self._write_manifest(manifest)
+        return True
+
+    def remove_alias(self, name, alias):
+        """Remove an alias of a name, returns False if it isn't set."""
+        with self.locked():
+            manifest = copy.deepcopy(self.manifest())
+            if manifest['aliases'].get(name, {}).pop(alias, None) is None:
+                return False
+            self._write_manifest(manifest)
+        return True
+
+    def latest_upload(self, name):
+        """Path and upload time of the model uploaded last under a name, or None."""
+        entries = self.manifest()['models'].get(name)
+        if not entries:
+            return None
+        entry = max(entries, key=lambda e: e['uploaded_at'])
+        return self.model_path(name, entry['filename']), entry['uploaded_at']
+
+    def resolve(self, name, alias):
+        """Path of the model an alias or tag of a name refers to, None if the store doesn't know it."""
+        manifest = self.manifest()
+        filename = manifest['aliases'].get(name, {}).get(alias)
+        if filename is None:
+            tagged = [e for e in manifest['models'].get(name, []) if alias in e['tags']]
+            if not tagged:
+                return None
+            filename = max(tagged, key=lambda e: e['trained_at'])['filename']
+        return self.model_path(name, filename)
+
+    def _apply_retention(self, manifest, name):
+        entries = sorted(manifest['models'][name], key=lambda e: e['trained_at'], reverse=True)
+        aliased = set(manifest['aliases'].get(name, {}).values())
+        last_upload = max(entries, key=lambda e: e['uploaded_at'])
+        kept = [
+            e for i, e in enumerate(entries)
+            if not self.keep_last or i < self.keep_last or e['tags'] or e['filename'] in aliased or e is last_upload
+        ]
+        for entry in entries:
+            if entry not in kept:
+                path = self.model_path(name, entry['filename'])
+                if os.path.exists(path):
+                    os.remove(path)
+        manifest['models'][name] = kept
+
+    def collect_garbage(self, upload_expiry_seconds=None):
+        """Remove blobs no model refers to, fingerprints of changed files, and uploads and chunk indexes unused for `upload_expiry_seconds`."""
+        removed = 0
+        with self.locked():
+            referenced = {e['sha256'] for entries in self.manifest()['models'].values() for e in entries}
+            for root, _, files in os.walk(self.blobs_dir, topdown=False):
+                for blob in files:
+                    if blob not in referenced:
+                        os.remove(os.path.join(root, blob))
+                        removed += 1
+                if root != self.blobs_dir and not os.listdir(root):
+                    # shard folders are created again by `add`
+                    os.rmdir(root)
+        if upload_expiry_seconds:
+            expired = time.time() - upload_expiry_seconds
+            self._remove_abandoned_uploads(expired)
+            self._remove_unused_chunk_indexes(referenced, expired)
+        remove_stale_fingerprints()
+        return removed
+
+    def _remove_unused_chunk_indexes(self, referenced, expired):
+        if not os.path.isdir(self.chunks_dir):
+            return
+        with os.scandir(self.chunks_dir) as it:
+            for entry in it:
+                try:
+                    sha256 = entry.name.split('.')[0]
+                    # indexes of an earlier chunking are never read again
+                    outdated = entry.name.endswith('.json') and entry.path != chunking.index_path(self.chunks_dir, sha256)
+                    if outdated or sha256 not in referenced and entry.stat().st_mtime < expired:
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+    def _remove_abandoned_uploads(self, expired):
+        uploads_dir = os.path.join(self.models_dir, UPLOADS_DIR)
+        if not os.path.isdir(uploads_dir):
+            return
+        # the files of an upload session share the id, a session is active while any of them changes
+        uploads = {}
+        with os.scandir(uploads_dir) as it:
+            for entry in it:
+                try:
+                    mtime = entry.stat().st_mtime
+                except FileNotFoundError:
+                    continue
+                upload_id = entry.name.split('.')[0]
+                paths, last_modified = uploads.get(upload_id, ([], 0))
+                uploads[upload_id] = (paths + [entry.path], max(last_modified, mtime))
+        for paths, last_modified in uploads.values():
+            if last_modified < expired:
+                for path in paths:
+                    if os.path.exists(path):
+                        os.remove(path)
+
+    def collect_garbage_periodically(self, interval_seconds, upload_expiry_seconds):
+        def run():
+            while True:
+                time.sleep(interval_seconds)
+                try:
+                    removed = self.collect_garbage(upload_expiry_seconds)
+                    if removed:
+                        print(f'Removed {removed} unreferenced model blobs', flush=True)
+                except Exception as e:
+                    print(f'Model garbage collection failed: {e}', flush=True)
+
+        threading.Thread(target=run, name='model-store-gc', daemon=True).start()
+
+# flake8: noqa: E501
@@ -0,0 +1,181 @@
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import uuid
+
+from filesystem import CHUNK_SIZE
+
+# uploads in progress are kept in this hidden folder of the models folder,
+# on the same filesystem so that finished uploads can be renamed into place
+UPLOADS_DIR = '.uploads'
+
+
+class ChecksumMismatch(Exception):
+    pass
+
+
+def write_stream(stream, fp, digest):
+    """Copy a request stream to a file in chunks, updating the digest on the way."""
+    written = 0
+    for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+        fp.write(chunk)
+        digest.update(chunk)
+        written += len(chunk)
+    return written
+
+
+def verify(tmp_path, sha256, expected_sha256=None):
+    """Check a fully written temporary file before it's moved into the model store.
+
+    The file is flushed to disk, so that the store can atomically rename it and
+    a model is never served partially written. With `expected_sha256` the file
+    is removed unless its content matches.
+    """
+    if expected_sha256 and expected_sha256.lower() != sha256:
+        os.remove(tmp_path)
+        raise ChecksumMismatch(f'Expected SHA-256 {expected_sha256}, received {sha256}')
+    with open(tmp_path, 'rb') as fp:
+        os.fsync(fp.fileno())
+
+
+def receive(stream, models_dir, expected_sha256=None):
+    """Stream an upload to a verified temporary file, returns its path and SHA-256."""
+    uploads_dir = os.path.join(models_dir, UPLOADS_DIR)
+    os.makedirs(uploads_dir, exist_ok=True)
+    tmp_path = os.path.join(uploads_dir, f'{uuid.uuid4().hex}.part')
+    digest = hashlib.sha256()
+    try:
+        with open(tmp_path, 'wb') as fp:
+            write_stream(stream, fp, digest)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    verify(tmp_path, digest.hexdigest(), expected_sha256)
+    return tmp_path, digest.hexdigest()
+
+
+class UploadSession:
+    def __init__(self, sessions, session_id, filename):
+        self.id = session_id
+        self.filename = filename
+        self.part_path = os.path.join(sessions.uploads_dir, f'{session_id}.part')
+        self.lock = threading.Lock()
+        self.digest = None
+        self.offset = 0
+
+    def load_digest(self):
+        """Hash what has been received so far.
+
+        Needed after a restart of the server, or when another worker process
+        received chunks of this upload.
+        """
+        self.digest = hashlib.sha256()
+        self.offset = 0
+        with open(self.part_path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(CHUNK_SIZE), b''):
+                self.digest.update(chunk)
+                self.offset += len(chunk)
+
+    def sync(self):
+        if self.digest is None or os.path.getsize(self.part_path) != self.offset:
+            self.load_digest()
+
+    def to_dict(self):
+        return {'id': self.id, 'filename': self.filename, 'offset': self.offset}
+
+
+class UploadSessions:
+    """Resumable uploads, sent as consecutive chunks.
+
+    A session is a `<id>.part` file with the data received so far and a
+    `<id>.json` file with the target filename, so sessions survive restarts.
+    Chunks are only accepted at the current end of the part file, a client
+    which lost track of a chunk asks for the offset and continues from there.
+    """
+
+    def __init__(self, models_dir):
+        self.models_dir = models_dir
+        self.uploads_dir = os.path.join(models_dir, UPLOADS_DIR)
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def create(self, filename):
+        os.makedirs(self.uploads_dir, exist_ok=True)
+        session = UploadSession(self, uuid.uuid4().hex, filename)
+        with open(os.path.join(self.uploads_dir, f'{session.id}.json'), 'w') as fp:
+            json.dump({'filename': filename}, fp)
+        open(session.part_path, 'wb').close()
+        session.digest = hashlib.sha256()
+        with self.lock:
+            self.sessions[session.id] = session
+        return session
+
+    def get(self, session_id):
+        """Return a session, or None if there is no such session."""
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session and not os.path.exists(session.part_path):
+                # completed or aborted by another worker
+                del self.sessions[session_id]
+                return None
+            if session is None:
+                try:
+                    uuid.UUID(hex=session_id)
+                    with open(os.path.join(self.uploads_dir, f'{session_id}.json')) as fp:
+                        filename = json.load(fp)['filename']
+                except (ValueError, OSError):
+                    return None
+                session = UploadSession(self, session_id, filename)
+                self.sessions[session_id] = session
+        with session.lock:
+            session.sync()
+        return session
+
+    def append(self, session, offset, stream):
+        """Append a chunk at `offset`, returns False if the offset is not the end of the received data."""
+        with session.lock, open(session.part_path, 'r+b') as fp:
+            # chunks of an upload may arrive at different worker processes
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            session.sync()
+            if offset != session.offset:
+                return False
+            digest = session.digest.copy()
+            fp.seek(offset)
+            try:
+                written = write_stream(stream, fp, digest)
+            except BaseException:
+                # drop the partial chunk so the client can send it again
+                fp.truncate(offset)
+                raise
+            session.digest = digest
+            session.offset += written
+            return True
+
+    def complete(self, session, expected_sha256=None):
+        """Finish an upload, returns the path and SHA-256 of the verified file for the model store."""
+        with session.lock, open(session.part_path, 'rb') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            session.sync()
+            sha256 = session.digest.hexdigest()
+            try:
+                verify(session.part_path, sha256, expected_sha256)
+            finally:
+                self._forget(session)
+            return session.part_path, sha256
+
+    def abort(self, session):
+        with session.lock:
+            if os.path.exists(session.part_path):
+                os.remove(session.part_path)
+            self._forget(session)
+
+    def _forget(self, session):
+        with self.lock:
+            self.sessions.pop(session.id, None)
+        json_path = os.path.join(self.uploads_dir, f'{session.id}.json')
+        if os.path.exists(json_path):
+            os.remove(json_path)
+
+# flake8: noqa: E501
@@ -0,0 +1,101 @@
+import asyncio
+from collections import OrderedDict
+
+# an account weighs as much as this many canned responses on top of its own ones,
+# for its index and snapshot, so accounts without canned responses are evicted too
+ACCOUNT_WEIGHT = 100
+
+
+class AccountResponses:
+    """Canned responses of a Chatwoot account, compiled together with the domain responses."""
+
+    def __init__(self, account_id, shared_snapshot, snapshot, version, responses, domain_hash):
+        self.account_id = account_id
+        self.shared_snapshot = shared_snapshot
+        self.snapshot = snapshot
+        self.version = version
+        self.responses = responses
+        self.domain_hash = domain_hash
+        # when refreshing the canned responses failed last
+        self.failed = 0
+
+    @property
+    def refreshed(self):
+        return self.snapshot['refreshed']
+
+    @property
+    def size(self):
+        return len(self.snapshot['canned_responses'])
+
+    @property
+    def weight(self):
+        return ACCOUNT_WEIGHT + self.size
+
+
+class AccountCache:
+    """Canned responses of the recently used Chatwoot accounts.
+
+    Accounts are loaded with `loader(account_id, previous)` on first use. When the
+    cached accounts weigh more than `max_responses` canned responses in total, the
+    least recently used accounts are evicted and passed to `on_evict`. Concurrent
+    loads of the same account share a single call of the loader.
+    """
+
+    def __init__(self, max_responses, loader, on_evict=None):
+        self.max_responses = max_responses
+        self.loader = loader
+        self.on_evict = on_evict
+        self.accounts = OrderedDict()
+        self.loading = {}
+        # canned responses and weight of the cached accounts
+        self.size = 0
+        self.weight = 0
+
+    def __iter__(self):
+        return iter(list(self.accounts.values()))
+
+    def __len__(self):
+        return len(self.accounts)
+
+    def get(self, account_id):
+        account = self.accounts.get(account_id)
+        if account:
+            self.accounts.move_to_end(account_id)
+        return account
+
+    def is_loading(self, account_id):
+        return account_id in self.loading
+
+    async def load(self, account_id):
+        """Load or reload an account, sharing an in-flight load with concurrent callers."""
+        task = self.loading.get(account_id)
+        if task is None:
+            task = asyncio.ensure_future(self._load(account_id))
+            self.loading[account_id] = task
+            task.add_done_callback(lambda _: self.loading.pop(account_id, None))
+        return await asyncio.shield(task)
+
+    async def _load(self, account_id):
+        account = await self.loader(account_id, self.accounts.get(account_id))
+        self.put(account)
+        return account
+
+    def put(self, account):
+        previous = self.accounts.pop(account.account_id, None)
+        if previous:
+            self._removed(previous)
+        self.accounts[account.account_id] = account
+        self.size += account.size
+        self.weight += account.weight
+        # the account just put is never evicted
+        while self.weight > self.max_responses and len(self.accounts) > 1:
+            _, evicted = self.accounts.popitem(last=False)
+            self._removed(evicted)
+            if self.on_evict:
+                self.on_evict(evicted)
+
+    def _removed(self, account):
+        self.size -= account.size
+        self.weight -= account.weight
+
+# flake8: noqa: E501
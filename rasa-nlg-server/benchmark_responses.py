@@ -0,0 +1,73 @@
+"""Compare the compiled response index with a chain of TemplatedNaturalLanguageGenerator.
+
+Run inside the nlg server image: python benchmark_responses.py [--responses N]
+"""
+import argparse
+import asyncio
+import time
+
+from rasa.core.nlg import TemplatedNaturalLanguageGenerator
+from rasa.shared.core.domain import Domain
+from rasa.shared.core.events import SlotSet
+from rasa.shared.core.trackers import DialogueStateTracker
+
+from response_index import ResponseIndex
+
+DEFAULT_RESPONSE_NAME = "utter_default_response"
+DEFAULT_RESPONSE = "Sorry, I didn't understand that."
+
+
+async def chain_generate(canned_responses, domain_responses, response, tracker, channel_name):
+    """The lookup chain the nlg server used before the response index."""
+    for responses in (canned_responses, domain_responses):
+        message = await TemplatedNaturalLanguageGenerator(responses).generate(response, tracker, channel_name)
+        if message:
+            return message
+    for responses in (canned_responses, domain_responses):
+        message = await TemplatedNaturalLanguageGenerator(responses).generate(
+            DEFAULT_RESPONSE_NAME, tracker, channel_name)
+        if message:
+            return message
+    return {"text": DEFAULT_RESPONSE}
+
+
+async def bench(label, func, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        await func()
+    elapsed = time.perf_counter() - start
+    print(f'{label:<32} {elapsed / rounds * 1e6:10.2f} us/call')
+
+
+async def main(count, rounds):
+    canned_responses = {f'utter_canned_{i}': [{'text': f'Canned response {i}'}] for i in range(count)}
+    domain = Domain.from_dict({
+        "slots": {"name": {"type": "text", "mappings": [{"type": "custom"}]}},
+        "responses": {
+            **{f'utter_domain_{i}': [{'text': f'Hello {{name}}, this is response {i}'}, {'text': 'Hello'}]
+               for i in range(count)},
+            DEFAULT_RESPONSE_NAME: [{'text': 'Default'}],
+        },
+    })
+    tracker = DialogueStateTracker.from_events("bench", [SlotSet("name", "Anna")], domain.slots)
+    slots = tracker.current_slot_values()
+    index = ResponseIndex(canned_responses, domain.responses, DEFAULT_RESPONSE_NAME, DEFAULT_RESPONSE)
+
+    for label, response in (("canned hit", "utter_canned_1"), ("domain hit", "utter_domain_1"), ("miss", "utter_missing")):
+        await bench(f'chain, {label}', lambda: chain_generate(
+            canned_responses, domain.responses, response, tracker, "chatwoot"), rounds)
+
+        async def index_generate():
+            return index.generate(response, "chatwoot", slots)
+
+        await bench(f'index, {label}', index_generate, rounds)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark response lookup")
+    parser.add_argument("--responses", default=500, type=int, help="number of canned and domain responses")
+    parser.add_argument("--rounds", default=10000, type=int, help="calls per measurement")
+    args = parser.parse_args()
+    asyncio.run(main(args.responses, args.rounds))
+
+# flake8: noqa: E501
@@ -0,0 +1,71 @@
+import multiprocessing
+import os
+import tempfile
+
+
+def _clear_metrics_dir(metrics_dir):
+    """Remove the metrics of earlier runs."""
+    os.makedirs(metrics_dir, exist_ok=True)
+    for name in os.listdir(metrics_dir):
+        if name.endswith('.db'):
+            os.remove(os.path.join(metrics_dir, name))
+
+
+# metrics of all sanic workers are aggregated through files in this directory,
+# it has to be set before prometheus_client is imported
+if not os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = tempfile.mkdtemp(prefix='nlg_metrics_')
+elif multiprocessing.parent_process() is None:
+    # metrics of earlier runs are removed before the metrics below open their files,
+    # a file removed later would keep getting the writes; forked workers skip this
+    _clear_metrics_dir(os.environ['PROMETHEUS_MULTIPROC_DIR'])
+
+from prometheus_client import (  # noqa: E402
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+)
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+RESPONSE_LATENCY = Histogram(
+    'nlg_response_duration_seconds', 'Time to generate a /nlg response, by response source',
+    ['source'], buckets=LATENCY_BUCKETS)
+BATCH_LATENCY = Histogram(
+    'nlg_batch_duration_seconds', 'Time to generate the responses of a /nlg/batch request',
+    buckets=LATENCY_BUCKETS)
+RESPONSES_GENERATED = Counter(
+    'nlg_responses_total', 'Generated responses, by response source', ['source'])
+TRACKER_LATENCY = Histogram(
+    'nlg_tracker_duration_seconds', 'Time to get the slot values from a tracker, by method (scan or replay)',
+    ['method'], buckets=LATENCY_BUCKETS)
+REFRESH_LATENCY = Histogram(
+    'nlg_refresh_duration_seconds', 'Time to fetch and load the domain or the canned responses of an account',
+    ['target'], buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+REFRESH_FAILURES = Counter(
+    'nlg_refresh_failures_total', 'Failed refreshes of the domain or the canned responses of an account',
+    ['target'])
+SNAPSHOT_VERSION = Gauge(
+    'nlg_snapshot_version', 'Version of the loaded domain snapshot', multiprocess_mode='max')
+SNAPSHOT_REFRESHED = Gauge(
+    'nlg_snapshot_refreshed_timestamp_seconds', 'When the loaded domain was last fetched',
+    multiprocess_mode='max')
+ACCOUNTS_CACHED = Gauge(
+    'nlg_accounts_cached', 'Chatwoot accounts with cached canned responses, per worker', multiprocess_mode='liveall')
+CANNED_RESPONSES_CACHED = Gauge(
+    'nlg_canned_responses_cached', 'Cached canned responses of all accounts, per worker', multiprocess_mode='liveall')
+RENDER_CACHE_HITS = Counter(
+    'nlg_render_cache_hits_total', 'Slot independent responses served from the render cache')
+RENDER_CACHE_MISSES = Counter(
+    'nlg_render_cache_misses_total', 'Slot independent responses rendered and added to the cache')
+
+
+def latest_metrics():
+    """Return the metrics of all workers in the Prometheus text format."""
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def mark_worker_stopped():
+    multiprocess.mark_process_dead(os.getpid())
+
+# flake8: noqa: E501
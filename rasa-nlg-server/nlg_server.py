@@ -1,18 +1,30 @@
 import argparse
+import hashlib
+import json
 import os
+import random
+import re
+import tempfile
 import time
 import yaml
 import asyncio
 
+# has to be imported before prometheus_client
+import metrics
+
 from sanic import Sanic, response
 
 from rasa.shared.core.domain import Domain
-from rasa.core.nlg import TemplatedNaturalLanguageGenerator
 from rasa.shared.core.trackers import DialogueStateTracker
 from rasa.constants import ENV_SANIC_BACKLOG, DEFAULT_SANIC_WORKERS
 from sanic.log import logger, logging
-from aiohttp import ClientSession
-from aiohttp_retry import RetryClient 
+
+from accounts import AccountCache, AccountResponses
+from render_cache import RenderCache
+from response_index import SOURCE_DOMAIN, ResponseIndex, ResponseSet
+from snapshot import SharedSnapshot
+from tracker_view import current_slot_values
+from upstream import UpstreamClient
 
 # from requests.adapters import HTTPAdapter
 # from requests.packages.urllib3.util.retry import Retry
@@ -20,11 +32,41 @@ from aiohttp_retry import RetryClient
 DEFAULT_SERVER_PORT = 5056
 DEFAULT_RESPONSE_NAME = "utter_default_response"
 DEFAULT_RESPONSE = "Sorry, I didn't understand that."
-CANNED_RESPONSES = {}
-CANNED_RESPONSES_REFRESHED = 0
+DEFAULT_ACCOUNT_ID = int(os.environ.get('NLG_CHATWOOT_ACCOUNT_ID', 1))
 REFRESH_SECONDS = int(os.environ.get('NLG_CHATWOOT_REFRESH_SECONDS', 60))
+ACCOUNTS = AccountCache(int(os.environ.get('NLG_CANNED_RESPONSES_BUDGET', 100000)),
+                        lambda account_id, previous: load_account(account_id, previous),
+                        lambda account: forget_account(account))
+# background refreshes of accounts, referenced until they finish
+ACCOUNT_REFRESHES = set()
+# how often a worker loading an account checks whether another worker fetching it is done
+ACCOUNT_FETCH_POLL_SECONDS = 0.05
+# Chatwoot account ids are positive integers, they are part of urls and file names
+ACCOUNT_ID_PATTERN = re.compile(r'[1-9][0-9]{0,17}')
 DOMAIN = {}
+# compiled domain responses, shared by the responses of all accounts
+DOMAIN_RESPONSES = None
+DOMAIN_REFRESHED = 0
+INITIAL_SLOT_VALUES = {}
+REFRESH_TASK = None
+SNAPSHOT = SharedSnapshot(os.environ.get('NLG_SNAPSHOT_PATH', os.path.join(tempfile.gettempdir(), 'nlg_server_snapshot')))
+SNAPSHOT_POLL_SECONDS = float(os.environ.get('NLG_SNAPSHOT_POLL_SECONDS', 1))
+SNAPSHOT_VERSION = 0
 DOMAIN_PATH = os.environ.get('NLG_DOMAIN_PATH', "")
+DOMAIN_FILE = None
+DOMAIN_HASH = None
+HTTP_CACHE = {}
+RENDER_CACHE = RenderCache(int(os.environ.get('NLG_RENDER_CACHE_SIZE', 1024)))
+HTTP = UpstreamClient(
+    pool_size=int(os.environ.get('NLG_HTTP_POOL_SIZE', 10)),
+    connect_timeout=float(os.environ.get('NLG_HTTP_CONNECT_TIMEOUT', 5)),
+    read_timeout=float(os.environ.get('NLG_HTTP_READ_TIMEOUT', 30)),
+    attempts=int(os.environ.get('NLG_HTTP_ATTEMPTS', 3)),
+    backoff_seconds=float(os.environ.get('NLG_HTTP_BACKOFF_SECONDS', 0.5)),
+    max_backoff_seconds=float(os.environ.get('NLG_HTTP_MAX_BACKOFF_SECONDS', 10)),
+    breaker_failures=int(os.environ.get('NLG_HTTP_BREAKER_FAILURES', 5)),
+    breaker_seconds=float(os.environ.get('NLG_HTTP_BREAKER_SECONDS', 30)),
+)
 DEBUG = os.environ.get('NLG_DEBUG', 'False').lower() in ('true', '1', 't')
 
 
@@ -49,14 +91,43 @@ def create_argument_parser():
     return parser
 
 
+def content_hash(data):
+    """Hash json-like data independently of the key order."""
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+async def get_json(url, headers, params=None):
+    """GET a json document with a conditional request if it has been fetched before.
+
+    When the server answers 304 Not Modified, the previously fetched document is returned.
+    """
+    cached = HTTP_CACHE.get(url)
+    if cached:
+        headers = dict(headers, **{"If-None-Match": cached[0]})
+    status, response_headers, data = await HTTP.get_json(url, headers=headers, params=params)
+    if status == 304 and cached:
+        logger.debug(f'Not modified: {url}')
+        return cached[1]
+    if response_headers.get("ETag"):
+        HTTP_CACHE[url] = (response_headers["ETag"], data)
+    return data
+
+
 async def get_domain():
     """If local domain file is present, read that file. 
        Otherwise, Request domain file from Rasa."""
+    global DOMAIN_FILE
+
     if DOMAIN_PATH:
+        stat = os.stat(DOMAIN_PATH)
+        if DOMAIN_FILE and DOMAIN_FILE[0] == (stat.st_mtime_ns, stat.st_size):
+            logger.debug(f'Domain file {DOMAIN_PATH} not modified')
+            return DOMAIN_FILE[1]
         with open(DOMAIN_PATH, "r") as stream:
             try:
                 domain_yaml = yaml.safe_load(stream)
                 logger.debug(f'Loaded domain from file {DOMAIN_PATH}:\n{domain_yaml}')
+                DOMAIN_FILE = ((stat.st_mtime_ns, stat.st_size), domain_yaml)
                 return domain_yaml
             except yaml.YAMLError as exc:
                 raise SystemExit(exc, f"Error reading domain from {DOMAIN_PATH}")
@@ -68,99 +139,424 @@ async def get_domain():
     params = {}
     if rasa_token:
         params["token"] = rasa_token
-    client_session = ClientSession()
-    retry_client = RetryClient(client_session=client_session)
-    async with retry_client.get(request_url, headers=headers, params=params) as response:
-        domain = await response.json()
-        logger.debug(f'Received domain from Rasa:\n{domain}')
-        await client_session.close()
-        return domain
-
-
-async def refresh_responses():
-    """Call chatwoot api to get canned responses and get the model domain data."""
-    global CANNED_RESPONSES
-    global CANNED_RESPONSES_REFRESHED
-    global DOMAIN
+    domain = await get_json(request_url, headers, params=params)
+    logger.debug(f'Received domain from Rasa:\n{domain}')
+    return domain
+
 
-    logger.info('Refreshing responses...')
+def canned_responses_url(account_id):
     chatwoot_url = os.environ.get("CHATWOOT_URL", "http://localhost:3000")
+    return f'{chatwoot_url}/api/v1/accounts/{account_id}/canned_responses'
+
+
+async def fetch_canned_responses(account_id):
+    """Call chatwoot api to get the canned responses of an account."""
+    logger.info(f'Refreshing canned responses of account {account_id}...')
     chatwoot_api_key = os.environ['CHATWOOT_API_KEY']
-    request_url = f'{chatwoot_url}/api/v1/accounts/1/canned_responses'
+    request_url = canned_responses_url(account_id)
     headers = {"Content-Type": "application/json", "api_access_token": chatwoot_api_key}
-    client_session = ClientSession()
-    retry_client = RetryClient(client_session=client_session)
-    async with retry_client.get(request_url, headers=headers, raise_for_status=True) as response:
-        responses = await response.json()
-        CANNED_RESPONSES = {f'utter_{r["short_code"]}': [{'text': r['content']}] for r in responses}
-        logger.debug(f'Refreshed CANNED_RESPONSES: {CANNED_RESPONSES}')
-        DOMAIN = Domain.from_dict(await get_domain())
-        logger.debug(f'Refreshed DOMAIN: {DOMAIN}')
-        await client_session.close()
+    responses = await get_json(request_url, headers)
+    canned_responses = {f'utter_{r["short_code"]}': [{'text': r['content']}] for r in responses}
+    logger.debug(f'Fetched canned responses of account {account_id}: {canned_responses}')
+    return canned_responses
+
+
+async def refresh_domain():
+    """Fetch a new snapshot of the domain and swap it in.
+
+    Concurrent callers share a single in-flight fetch.
+    """
+    global REFRESH_TASK
+
+    if REFRESH_TASK is None or REFRESH_TASK.done():
+        REFRESH_TASK = asyncio.ensure_future(_refresh_domain())
+    await asyncio.shield(REFRESH_TASK)
+
+
+async def _refresh_domain():
+    global DOMAIN_REFRESHED
+
+    with metrics.REFRESH_LATENCY.labels("domain").time(), \
+            metrics.REFRESH_FAILURES.labels("domain").count_exceptions((Exception, SystemExit)):
+        logger.info('Refreshing domain...')
+        domain = await get_domain()
+        snapshot = {'domain': domain, 'domain_hash': content_hash(domain), 'refreshed': time.time()}
+        if snapshot['domain_hash'] == DOMAIN_HASH:
+            logger.info('Domain not changed')
+            DOMAIN_REFRESHED = snapshot['refreshed']
+            metrics.SNAPSHOT_REFRESHED.set(DOMAIN_REFRESHED)
+            return
+        load_domain(snapshot)
+
+
+def load_domain(snapshot, version=None):
+    """Build the domain of a snapshot and swap it in, together with the responses of all cached accounts.
+
+    Snapshots without a version are freshly fetched ones, they are published to
+    the other workers once they have been built successfully.
+    """
+    global DOMAIN
+    global DOMAIN_HASH
+    global DOMAIN_RESPONSES
+    global DOMAIN_REFRESHED
+    global INITIAL_SLOT_VALUES
+    global SNAPSHOT_VERSION
+
+    domain = Domain.from_dict(snapshot['domain'])
+    logger.debug(f'Loaded domain: {domain}')
+    initial_slot_values = {slot.name: slot.initial_value for slot in domain.slots}
+    domain_responses = ResponseSet(SOURCE_DOMAIN, domain.responses, DOMAIN_RESPONSES)
+    accounts = list(ACCOUNTS)
+    account_responses = [
+        ResponseIndex(account.snapshot['canned_responses'], domain_responses, DEFAULT_RESPONSE_NAME,
+                      DEFAULT_RESPONSE, account.responses)
+        for account in accounts
+    ]
+    if version is None:
+        version = SNAPSHOT.publish(snapshot)
+
+    DOMAIN, DOMAIN_HASH, DOMAIN_RESPONSES, INITIAL_SLOT_VALUES = domain, snapshot['domain_hash'], domain_responses, initial_slot_values
+    for account, responses in zip(accounts, account_responses):
+        account.responses, account.domain_hash = responses, DOMAIN_HASH
+    RENDER_CACHE.clear()
+    DOMAIN_REFRESHED = snapshot['refreshed']
+    SNAPSHOT_VERSION = version
+    metrics.SNAPSHOT_VERSION.set(SNAPSHOT_VERSION)
+    metrics.SNAPSHOT_REFRESHED.set(DOMAIN_REFRESHED)
+
+
+def reload_domain():
+    """Load the snapshot published by the refreshing worker if there is a new version."""
+    published = SNAPSHOT.read_if_changed()
+    if published:
+        version, snapshot = published
+        logger.info(f'Loading domain snapshot version {version}')
+        load_domain(snapshot, version)
+
+
+async def refresh_domain_periodically():
+    """Keep the domain fresh in the background, keeping the last good one on errors.
+
+    Only the worker holding the snapshot lock fetches the domain, the other
+    workers reload the snapshots it publishes.
+    """
+    failed = 0
+    while True:
+        try:
+            if SNAPSHOT.acquire_refresher():
+                if time.time() >= max(DOMAIN_REFRESHED, failed) + REFRESH_SECONDS:
+                    await refresh_domain()
+            else:
+                reload_domain()
+        except asyncio.CancelledError:
+            raise
+        except (Exception, SystemExit) as e:
+            logger.error(f'Failed to refresh domain, serving the previous one: {e}')
+            logger.debug(e, exc_info=True)
+            failed = time.time()
+        await asyncio.sleep(SNAPSHOT_POLL_SECONDS)
+
+
+async def ensure_domain():
+    if DOMAIN_HASH is None:
+        # nothing has been loaded yet, the background refresher keeps it fresh afterwards
+        reload_domain()
+    if DOMAIN_HASH is None:
+        await refresh_domain()
+
+
+def build_account(account_id, shared_snapshot, snapshot, version, previous):
+    if previous and previous.domain_hash == DOMAIN_HASH \
+            and previous.snapshot['canned_responses_hash'] == snapshot['canned_responses_hash']:
+        responses = previous.responses
+    else:
+        responses = ResponseIndex(snapshot['canned_responses'], DOMAIN_RESPONSES, DEFAULT_RESPONSE_NAME,
+                                  DEFAULT_RESPONSE, previous.responses if previous else None)
+    return AccountResponses(account_id, shared_snapshot, snapshot, version, responses, DOMAIN_HASH)
+
+
+def account_snapshot(account_id):
+    return SharedSnapshot(f'{SNAPSHOT.path}.account_{account_id}')
+
+
+async def load_account(account_id, previous):
+    """Load the canned responses of an account.
+
+    A fresh snapshot published by another worker is used when there is one,
+    otherwise a single worker fetches the canned responses from Chatwoot and
+    publishes them for the other workers. While another worker fetches them, a
+    cached account is kept as it is and an account loaded for the first time
+    waits for the snapshot.
+    """
+    with metrics.REFRESH_LATENCY.labels("account").time(), \
+            metrics.REFRESH_FAILURES.labels("account").count_exceptions():
+        shared_snapshot = previous.shared_snapshot if previous else account_snapshot(account_id)
+        while True:
+            with shared_snapshot.fetching() as fetching:
+                # read once the lock is held, the worker fetching before may just have published
+                published = shared_snapshot.read_if_changed()
+                if published and time.time() - published[1]['refreshed'] < REFRESH_SECONDS:
+                    version, snapshot = published
+                    break
+                if fetching:
+                    canned_responses = await fetch_canned_responses(account_id)
+                    snapshot = {
+                        'canned_responses': canned_responses,
+                        'canned_responses_hash': content_hash(canned_responses),
+                        'refreshed': time.time(),
+                    }
+                    version = shared_snapshot.publish(snapshot)
+                    break
+            if previous:
+                # the snapshot of the other worker is loaded by a later refresh
+                return previous
+            await asyncio.sleep(ACCOUNT_FETCH_POLL_SECONDS)
+        return build_account(account_id, shared_snapshot, snapshot, version, previous)
+
+
+def forget_account(account):
+    """Drop what is kept of an evicted account besides its responses."""
+    HTTP_CACHE.pop(canned_responses_url(account.account_id), None)
+
+
+async def refresh_account(account_id):
+    try:
+        await ACCOUNTS.load(account_id)
+    except Exception as e:
+        logger.error(f'Failed to refresh canned responses of account {account_id}, serving the previous ones: {e}')
+        logger.debug(e, exc_info=True)
+        account = ACCOUNTS.get(account_id)
+        if account:
+            account.failed = time.time()
+
+
+async def get_account(account_id):
+    """Return the responses of an account, its canned responses are loaded on first use.
+
+    Stale canned responses keep being served while they are refreshed in the background.
+    If they can't be loaded at all, the domain responses are served until the next refresh.
+    """
+    account = ACCOUNTS.get(account_id)
+    if account is None:
+        try:
+            account = await ACCOUNTS.load(account_id)
+        except Exception as e:
+            logger.error(f'Failed to load canned responses of account {account_id}: {e}')
+            logger.debug(e, exc_info=True)
+            snapshot = {'canned_responses': {}, 'canned_responses_hash': None, 'refreshed': 0}
+            account = build_account(account_id, account_snapshot(account_id), snapshot, 0, None)
+            account.failed = time.time()
+            ACCOUNTS.put(account)
+        metrics.ACCOUNTS_CACHED.set(len(ACCOUNTS))
+        metrics.CANNED_RESPONSES_CACHED.set(ACCOUNTS.size)
+    elif time.time() >= max(account.refreshed, account.failed) + REFRESH_SECONDS and not ACCOUNTS.is_loading(account_id):
+        task = asyncio.ensure_future(refresh_account(account_id))
+        ACCOUNT_REFRESHES.add(task)
+        task.add_done_callback(refreshed_account)
+    return account
+
+
+def refreshed_account(task):
+    ACCOUNT_REFRESHES.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.error(f'Refreshing canned responses failed: {task.exception()}')
+
+
+def get_account_id(tracker_state):
+    """Get the Chatwoot account of the conversation from the metadata set by the Chatwoot channel.
+
+    Raises ValueError if the account id isn't a positive integer.
+    """
+    metadata = (tracker_state.get("latest_message") or {}).get("metadata") or {}
+    account_id = (metadata.get("account") or {}).get("id", DEFAULT_ACCOUNT_ID)
+    if isinstance(account_id, bool) or not ACCOUNT_ID_PATTERN.fullmatch(str(account_id)):
+        raise ValueError(f'Invalid Chatwoot account id: {account_id!r}')
+    return int(account_id)
+
+
+def get_filled_slots(tracker_state, slot_names):
+    """Get the values of the slots from the tracker state sent by Rasa."""
+    events = tracker_state.get("events")
+    with metrics.TRACKER_LATENCY.labels("scan").time():
+        filled_slots = current_slot_values(events, slot_names, INITIAL_SLOT_VALUES)
+    if filled_slots is None:
+        logger.debug('Replaying the tracker events to get the slot values')
+        with metrics.TRACKER_LATENCY.labels("replay").time():
+            tracker = DialogueStateTracker.from_dict(tracker_state.get("sender_id"), events, DOMAIN.slots)
+            filled_slots = tracker.current_slot_values()
+    return filled_slots
+
+
+def is_slot_independent(nlg_call, account):
+    """Check whether the response can be generated without knowing any slot values."""
+    return account.responses.referenced_slots(nlg_call.get("response")).isdisjoint(INITIAL_SLOT_VALUES)
+
+
+def render_response(nlg_call, account, filled_slots=None):
+    """Generate the message of a nlg call, returns its source and the message.
 
-    CANNED_RESPONSES_REFRESHED = time.time()
+    `filled_slots` can be left out for slot independent responses, their rendered
+    variations are cached.
+    """
+    kwargs = nlg_call.get("arguments", {})
+    response = nlg_call.get("response")
+    channel = nlg_call.get("channel")
+    # Rasa sends the channel as {"name": <channel name>}
+    channel_name = channel.get("name") if isinstance(channel, dict) else channel
+
+    logger.info(f'Generating message for response: {response}, account: {account.account_id}')
+
+    if filled_slots is None:
+        key = (account.account_id, account.version, response, channel_name,
+               json.dumps(kwargs, sort_keys=True, default=str), SNAPSHOT_VERSION)
+        rendered = RENDER_CACHE.get(key)
+        if rendered is None:
+            metrics.RENDER_CACHE_MISSES.inc()
+            rendered = account.responses.generate_all(response, channel_name, INITIAL_SLOT_VALUES, **kwargs)
+            RENDER_CACHE.put(key, rendered)
+        else:
+            metrics.RENDER_CACHE_HITS.inc()
+        source, messages = rendered
+        message = dict(random.choice(messages))
+    else:
+        source, message = account.responses.generate(response, channel_name, filled_slots, **kwargs)
+    metrics.RESPONSES_GENERATED.labels(source).inc()
+    logger.info(f'Returning {source} response: {message}')
+    return source, message
 
 
 async def generate_response(nlg_call):
     """Mock response generator.
 
     Generates the responses from canned responses or the bot's domain file.
+    Returns the source of the response and the message.
     """
+    await ensure_domain()
 
-    kwargs = nlg_call.get("arguments", {})
-    response = nlg_call.get("response")
-    sender_id = nlg_call.get("tracker", {}).get("sender_id")
-    events = nlg_call.get("tracker", {}).get("events")
-    tracker = DialogueStateTracker.from_dict(sender_id, events, DOMAIN.slots)
-    channel_name = nlg_call.get("channel")
+    tracker_state = nlg_call.get("tracker", {})
+    account = await get_account(get_account_id(tracker_state))
+    if is_slot_independent(nlg_call, account):
+        return render_response(nlg_call, account)
 
-    logger.info(f'Generating message for response: {response}')
+    slot_names = account.responses.referenced_slots(nlg_call.get("response"))
+    filled_slots = get_filled_slots(tracker_state, slot_names)
+    return render_response(nlg_call, account, filled_slots)
 
-    if not CANNED_RESPONSES or not DOMAIN or time.time() - CANNED_RESPONSES_REFRESHED > REFRESH_SECONDS:
-        await refresh_responses()
 
-    message = await TemplatedNaturalLanguageGenerator(CANNED_RESPONSES).generate(
-        response, tracker, channel_name, **kwargs)
-    if message:
-        logger.info(f'Returning canned response: {message}')
-        return message
+async def generate_responses(batch):
+    """Generate the responses of many nlg calls.
 
-    message = await TemplatedNaturalLanguageGenerator(DOMAIN.responses).generate(
-        response, tracker, channel_name, **kwargs
-    )
-    if message:
-        logger.info(f'Returning domain response: {message}')
-        return message
-
-    default_response = await TemplatedNaturalLanguageGenerator(CANNED_RESPONSES).generate(
-        DEFAULT_RESPONSE_NAME, tracker, channel_name, **kwargs)
-    if default_response:
-        logger.info(f'Returning canned default response {default_response}')
-        return default_response
-
-    default_response = await TemplatedNaturalLanguageGenerator(DOMAIN.responses).generate(
-        DEFAULT_RESPONSE_NAME, tracker, channel_name, **kwargs)
-    if default_response:
-        logger.info(f'Returning default domain response {default_response}')
-        return default_response
-        
-    logger.info(f'Returning built-in default response {DEFAULT_RESPONSE}')
-    return {"text": DEFAULT_RESPONSE}
+    `batch["calls"]` is a list of calls in the format of the `/nlg` endpoint. Instead
+    of sending its own `tracker`, a call can refer to a tracker in `batch["trackers"]`
+    by its key in `tracker_id`. The slots of every distinct tracker are resolved
+    once for all the calls using it, slot independent responses don't need them at
+    all. Returns the messages in the order of the calls.
+    """
+    await ensure_domain()
+
+    shared_trackers = batch.get("trackers", {})
+    trackers = {}
+    for index, nlg_call in enumerate(batch["calls"]):
+        if "tracker_id" in nlg_call:
+            tracker_id = nlg_call["tracker_id"]
+            if tracker_id not in shared_trackers:
+                raise ValueError(f'Unknown tracker_id: {tracker_id}')
+            trackers[index] = (("shared", tracker_id), shared_trackers[tracker_id])
+        else:
+            trackers[index] = (("call", index), nlg_call.get("tracker", {}))
+
+    accounts = {}
+    for _, tracker_state in trackers.values():
+        account_id = get_account_id(tracker_state)
+        if account_id not in accounts:
+            accounts[account_id] = await get_account(account_id)
+
+    messages = [None] * len(batch["calls"])
+    calls_by_tracker = {}
+    for index, nlg_call in enumerate(batch["calls"]):
+        key, tracker_state = trackers[index]
+        account = accounts[get_account_id(tracker_state)]
+        if is_slot_independent(nlg_call, account):
+            _, messages[index] = render_response(nlg_call, account)
+        else:
+            calls_by_tracker.setdefault(key, []).append(index)
+
+    for key, indexes in calls_by_tracker.items():
+        tracker_state = trackers[indexes[0]][1]
+        account = accounts[get_account_id(tracker_state)]
+        calls = [batch["calls"][index] for index in indexes]
+        slot_names = set().union(*(account.responses.referenced_slots(nlg_call.get("response")) for nlg_call in calls))
+        filled_slots = get_filled_slots(tracker_state, slot_names)
+        for index, nlg_call in zip(indexes, calls):
+            _, messages[index] = render_response(nlg_call, account, filled_slots)
+    return messages
+
+
+async def preload_responses():
+    """Load the domain and the canned responses of the default account."""
+    HTTP.start()
+    try:
+        await refresh_domain()
+        await ACCOUNTS.load(DEFAULT_ACCOUNT_ID)
+    finally:
+        await HTTP.close()
 
 
 def run_server(port, workers):
     app = Sanic("nlg_server")
     logger.setLevel(logging.DEBUG if DEBUG else logging.INFO)
 
+    @app.listener("before_server_start")
+    async def start_http_client(app, loop):
+        HTTP.start()
+
+    @app.listener("after_server_start")
+    async def start_refresher(app, loop):
+        app.ctx.refresher = loop.create_task(refresh_domain_periodically())
+
+    @app.listener("before_server_stop")
+    async def stop_refresher(app, loop):
+        app.ctx.refresher.cancel()
+        metrics.mark_worker_stopped()
+
+    @app.listener("after_server_stop")
+    async def close_http_client(app, loop):
+        await HTTP.close()
+
     @app.route("/nlg", methods=["POST", "OPTIONS"])
     async def nlg(request):
         """Endpoint which processes the Core request for a bot response."""
         nlg_call = request.json
-        bot_response = await generate_response(nlg_call)
+        start = time.perf_counter()
+        try:
+            source, bot_response = await generate_response(nlg_call)
+        except ValueError as e:
+            return response.json({"error": str(e)}, status=400)
+        metrics.RESPONSE_LATENCY.labels(source).observe(time.perf_counter() - start)
 
         return response.json(bot_response)
         return None
 
+    @app.route("/nlg/batch", methods=["POST", "OPTIONS"])
+    async def nlg_batch(request):
+        """Endpoint which generates the responses of many calls in one request."""
+        batch = request.json
+        if not isinstance(batch, dict) or not isinstance(batch.get("calls"), list):
+            return response.json({"error": "Expected a json object with a list of calls"}, status=400)
+        try:
+            with metrics.BATCH_LATENCY.time():
+                bot_responses = await generate_responses(batch)
+        except ValueError as e:
+            return response.json({"error": str(e)}, status=400)
+
+        return response.json({"responses": bot_responses})
+
+    @app.route("/metrics", methods=["GET"])
+    async def prometheus_metrics(request):
+        """Endpoint which exposes Prometheus metrics aggregated over all workers."""
+        body, content_type = metrics.latest_metrics()
+        return response.raw(body, content_type=content_type)
+
     app.run(
         host="0.0.0.0",
         port=port,
@@ -177,7 +573,7 @@ if __name__ == "__main__":
     # Running as standalone python application
     arg_parser = create_argument_parser()
     cmdline_args = arg_parser.parse_args()
-    asyncio.run(refresh_responses())
+    asyncio.run(preload_responses())
 
     run_server(cmdline_args.port, cmdline_args.workers)
 
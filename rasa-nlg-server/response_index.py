@@ -0,0 +1,194 @@
+import copy
+import random
+import re
+
+from rasa.core.nlg import interpolator
+from rasa.shared.constants import RESPONSE_CONDITION, CHANNEL
+
+# same placeholder syntax as rasa.core.nlg.interpolator
+PLACEHOLDER_PATTERN = re.compile(r"{([^\n{}]+?)}")
+# keys of a response which rasa interpolates
+INTERPOLATED_KEYS = ["text", "image", "custom", "buttons", "attachment", "quick_replies"]
+
+# where a generated response came from, in order of precedence
+SOURCE_CANNED = "canned"
+SOURCE_DOMAIN = "domain"
+SOURCE_CANNED_DEFAULT = "canned_default"
+SOURCE_DOMAIN_DEFAULT = "domain_default"
+SOURCE_BUILTIN_DEFAULT = "builtin_default"
+
+
+def _strings(value):
+    """Yield all strings nested in a response value."""
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from _strings(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from _strings(item)
+
+
+class CompiledVariant:
+    """One variation of a response, parsed once when the index is built."""
+
+    def __init__(self, variant):
+        self.variant = variant
+        self.condition = [(c["name"], c["value"]) for c in variant.get(RESPONSE_CONDITION) or []]
+        strings = [s for key in INTERPOLATED_KEYS if key in variant for s in _strings(variant[key])]
+        self.placeholders = {name for s in strings for name in PLACEHOLDER_PATTERN.findall(s)}
+        self.is_static = not any('{' in s or '}' in s for s in strings)
+
+    def matches(self, filled_slots):
+        return all(filled_slots.get(name) == value for name, value in self.condition)
+
+    def render(self, values):
+        """Fill the placeholders like TemplatedNaturalLanguageGenerator does."""
+        if self.is_static or not values:
+            return dict(self.variant)
+        response = copy.deepcopy(self.variant)
+        for key in INTERPOLATED_KEYS:
+            if key in response:
+                response[key] = interpolator.interpolate(response[key], values)
+        return response
+
+
+class CompiledResponse:
+    """All variations of a response, pre-filtered by channel and condition.
+
+    Variation selection follows `TemplatedNaturalLanguageGenerator`: conditional
+    variations for the channel, then default variations for the channel, then
+    conditional variations without a channel, then default ones without a channel.
+    """
+
+    def __init__(self, variants):
+        self.source_variants = variants
+        self.conditional_by_channel = {}
+        self.conditional_no_channel = []
+        self.default_by_channel = {}
+        self.default_no_channel = []
+        # slots which may be read to select or fill a variation
+        self.slots = set()
+
+        for variant in variants:
+            compiled = CompiledVariant(variant)
+            self.slots.update(compiled.placeholders, (name for name, _ in compiled.condition))
+            channel = variant.get(CHANNEL)
+            if variant.get(RESPONSE_CONDITION) is None:
+                if channel is None:
+                    self.default_no_channel.append(compiled)
+                else:
+                    self.default_by_channel.setdefault(channel, []).append(compiled)
+            elif variant.get(RESPONSE_CONDITION):
+                if channel is None:
+                    self.conditional_no_channel.append(compiled)
+                else:
+                    self.conditional_by_channel.setdefault(channel, []).append(compiled)
+
+        self.is_conditional = bool(self.conditional_no_channel or self.conditional_by_channel)
+
+    def variants(self, output_channel, filled_slots):
+        """Return the variations suitable for the channel and the slot values."""
+        if self.is_conditional:
+            matching = [v for v in self.conditional_by_channel.get(output_channel, []) if v.matches(filled_slots)]
+            if matching:
+                return matching
+
+        default_channel = self.default_by_channel.get(output_channel)
+        if default_channel:
+            return default_channel
+
+        if self.is_conditional:
+            matching = [v for v in self.conditional_no_channel if v.matches(filled_slots)]
+            if matching:
+                return matching
+
+        return self.default_no_channel
+
+
+class ResponseSet:
+    """The compiled responses of one source, like the domain responses all accounts share.
+
+    When a `previous` set is given, responses which didn't change since it was
+    built are reused instead of compiled again.
+    """
+
+    def __init__(self, source, responses, previous=None):
+        self.source = source
+        self.compiled = {}
+        for name, variants in responses.items():
+            compiled = previous.compiled.get(name) if previous else None
+            if compiled is None or compiled.source_variants != variants:
+                compiled = CompiledResponse(variants)
+            self.compiled[name] = compiled
+
+
+class ResponseIndex:
+    """Responses from Chatwoot and the domain merged into a single lookup.
+
+    A response name maps to its candidates in order of precedence: the canned
+    response first, then the domain response. When neither fits, the default
+    response is looked up the same way and the built-in default is used last.
+
+    The domain responses can be given as a `ResponseSet`, which is shared by the
+    indexes instead of compiled for each of them. When a `previous` index is
+    given, canned responses which didn't change since then are reused.
+    """
+
+    def __init__(self, canned_responses, domain_responses, default_response_name, default_response, previous=None):
+        self.canned = ResponseSet(SOURCE_CANNED, canned_responses, previous.canned if previous else None)
+        if not isinstance(domain_responses, ResponseSet):
+            domain_responses = ResponseSet(SOURCE_DOMAIN, domain_responses)
+        self.domain = domain_responses
+
+        self.defaults = []
+        for responses, default_source in ((self.canned, SOURCE_CANNED_DEFAULT), (self.domain, SOURCE_DOMAIN_DEFAULT)):
+            compiled = responses.compiled.get(default_response_name)
+            if compiled:
+                self.defaults.append((default_source, compiled))
+        self.builtin_default = CompiledVariant({"text": default_response})
+
+        self.default_slots = set().union(*(compiled.slots for _, compiled in self.defaults))
+        # slots of the responses looked up so far
+        self.slots = {}
+
+    def candidates(self, response_name):
+        """The source and the compiled response of each source having the response, in order of precedence."""
+        return [
+            (responses.source, responses.compiled[response_name])
+            for responses in (self.canned, self.domain) if response_name in responses.compiled
+        ]
+
+    def referenced_slots(self, response_name):
+        """Return the names which generating the response may read from the slots."""
+        slots = self.slots.get(response_name)
+        if slots is None:
+            candidates = self.candidates(response_name)
+            if not candidates:
+                return self.default_slots
+            slots = self.slots[response_name] = self.default_slots.union(*(compiled.slots for _, compiled in candidates))
+        return slots
+
+    def select(self, response_name, output_channel, filled_slots):
+        """Return the source and the suitable variations of a response."""
+        for candidates in (self.candidates(response_name), self.defaults):
+            for source, compiled in candidates:
+                variants = compiled.variants(output_channel, filled_slots)
+                if variants:
+                    return source, variants
+
+        return SOURCE_BUILTIN_DEFAULT, [self.builtin_default]
+
+    def generate(self, response_name, output_channel, filled_slots, **kwargs):
+        """Generate a response, returns the source it came from and the message."""
+        source, variants = self.select(response_name, output_channel, filled_slots)
+        return source, random.choice(variants).render(dict(filled_slots, **kwargs))
+
+    def generate_all(self, response_name, output_channel, filled_slots, **kwargs):
+        """Render all suitable variations, returns the source they came from and the messages."""
+        source, variants = self.select(response_name, output_channel, filled_slots)
+        values = dict(filled_slots, **kwargs)
+        return source, [variant.render(values) for variant in variants]
+
+# flake8: noqa: E501
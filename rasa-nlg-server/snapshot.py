@@ -0,0 +1,108 @@
+import fcntl
+import json
+import mmap
+import os
+import struct
+from contextlib import contextmanager
+
+# version and payload length
+HEADER = struct.Struct("<QQ")
+
+
+class SharedSnapshot:
+    """Responses snapshot shared by all workers of the nlg server.
+
+    One worker, the one holding the lock file, fetches the responses and publishes
+    them with `publish`. Every published snapshot gets a new version and is written
+    to a new file which atomically replaces the previous one, so readers never see
+    a partially written snapshot. The other workers map the file read-only and only
+    deserialize it when a new version has been published.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = f'{path}.lock'
+        self.lock_file = None
+        self.version = 0
+        self.inode = None
+
+    def acquire_refresher(self):
+        """Try to become the worker which refreshes the snapshot.
+
+        The lock is held until the process exits, then another worker takes over.
+        """
+        if self.lock_file:
+            return True
+        lock_file = open(self.lock_path, "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self.lock_file = lock_file
+        return True
+
+    @contextmanager
+    def fetching(self):
+        """Hold the lock file while fetching the snapshot, yields False if another worker is fetching it.
+
+        If fetching fails before any snapshot has been published, the lock file is
+        removed as well, so data which can't be fetched leaves no files behind.
+        """
+        lock_file = open(self.lock_path, "a")
+        try:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                yield False
+                return
+            try:
+                yield True
+            except BaseException:
+                if not os.path.exists(self.path):
+                    os.remove(self.lock_path)
+                raise
+        finally:
+            lock_file.close()
+
+    def publish(self, data):
+        """Write a new version of the snapshot, returns the version."""
+        current = self._read()
+        version = max(self.version, current[0] if current else 0) + 1
+        payload = json.dumps(data).encode()
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, "wb") as fp:
+            fp.write(HEADER.pack(version, len(payload)))
+            fp.write(payload)
+        os.replace(tmp_path, self.path)
+        self.version = version
+        self.inode = os.stat(self.path).st_ino
+        return version
+
+    def read_if_changed(self):
+        """Return `(version, data)` of the published snapshot if it is newer than the last one read."""
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            return None
+        if inode == self.inode:
+            return None
+
+        snapshot = self._read()
+        if snapshot is None:
+            return None
+        self.inode = inode
+        if snapshot[0] <= self.version:
+            return None
+        self.version = snapshot[0]
+        return snapshot
+
+    def _read(self):
+        try:
+            with open(self.path, "rb") as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                version, length = HEADER.unpack_from(mapped)
+                return version, json.loads(mapped[HEADER.size:HEADER.size + length])
+        except (FileNotFoundError, ValueError, struct.error):
+            return None
+
+# flake8: noqa: E501
@@ -0,0 +1,34 @@
+SLOT_EVENT = "slot"
+# events after which all slots have their initial values
+RESET_EVENTS = {"restart", "reset_slots", "session_started"}
+# events which revert earlier events, only a full tracker replay resolves them
+REVERT_EVENTS = {"rewind", "undo"}
+
+
+def current_slot_values(events, slot_names, initial_values):
+    """Get slot values from the tracker events without replaying the conversation.
+
+    The events are scanned from the latest one backwards and the scan stops as soon
+    as all `slot_names` are resolved, so the cost doesn't grow with the length of
+    the conversation. Slots not in `slot_names` keep their initial values.
+
+    Returns `None` if the events revert earlier events before the slots are
+    resolved, the caller has to build a full `DialogueStateTracker` then.
+    """
+    values = dict(initial_values)
+    pending = {name for name in slot_names if name in initial_values}
+    for event in reversed(events or []):
+        if not pending:
+            break
+        event_type = event.get("event")
+        if event_type == SLOT_EVENT:
+            name = event.get("name")
+            if name in pending:
+                values[name] = event.get("value")
+                pending.discard(name)
+        elif event_type in RESET_EVENTS:
+            break
+        elif event_type in REVERT_EVENTS:
+            return None
+
+    return values
@@ -0,0 +1,127 @@
+import asyncio
+import random
+import time
+from urllib.parse import urlsplit
+
+from aiohttp import ClientError, ClientResponseError, ClientSession, ClientTimeout, TCPConnector
+from sanic.log import logger
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a host whose circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Stop calling a host after consecutive failures.
+
+    After `max_failures` failed attempts in a row the circuit opens and calls
+    fail immediately for `reset_seconds`. Then a single trial call is let
+    through: if it succeeds the circuit closes, otherwise it opens again.
+    """
+
+    def __init__(self, max_failures, reset_seconds):
+        self.max_failures = max_failures
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened = 0
+        # when the trial call started, a trial which never finished is given up after `reset_seconds`
+        self.trial = 0
+
+    @property
+    def is_open(self):
+        return self.failures >= self.max_failures
+
+    def before_call(self, host):
+        if not self.is_open:
+            return
+        now = time.monotonic()
+        if now < max(self.opened, self.trial) + self.reset_seconds:
+            raise CircuitOpenError(f'Circuit breaker for {host} is open after {self.failures} failures')
+        self.trial = now
+
+    def succeeded(self):
+        self.failures = 0
+        self.trial = 0
+
+    def failed(self):
+        self.failures += 1
+        self.trial = 0
+        if self.is_open:
+            self.opened = time.monotonic()
+
+
+class UpstreamClient:
+    """Connection pooled HTTP client for the calls to Chatwoot and Rasa.
+
+    The session is created with `start` in the event loop which uses it and has
+    to be closed with `close`. Requests failing with connection errors, timeouts
+    or 5xx/429 responses are retried with jittered exponential backoff, and every
+    host gets its own circuit breaker.
+    """
+
+    def __init__(self, pool_size, connect_timeout, read_timeout, attempts, backoff_seconds, max_backoff_seconds,
+                 breaker_failures, breaker_seconds):
+        self.pool_size = pool_size
+        self.timeout = ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self.attempts = max(1, attempts)
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.breaker_failures = breaker_failures
+        self.breaker_seconds = breaker_seconds
+        self.breakers = {}
+        self.session = None
+
+    def start(self):
+        if self.session is None or self.session.closed:
+            connector = TCPConnector(limit=self.pool_size, limit_per_host=self.pool_size, ttl_dns_cache=300)
+            self.session = ClientSession(connector=connector, timeout=self.timeout)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def breaker(self, url):
+        host = urlsplit(url).netloc
+        if host not in self.breakers:
+            self.breakers[host] = CircuitBreaker(self.breaker_failures, self.breaker_seconds)
+        return host, self.breakers[host]
+
+    def backoff(self, attempt):
+        """Full jitter backoff, so workers retrying at once don't hit the host together."""
+        return random.uniform(0, min(self.max_backoff_seconds, self.backoff_seconds * 2 ** attempt))
+
+    async def get_json(self, url, headers=None, params=None):
+        """GET a json document, returns the status, the response headers and the document.
+
+        The document is None when the server answers 304 Not Modified. 4xx
+        responses other than 429 are raised without retrying.
+        """
+        if self.session is None:
+            raise RuntimeError('Upstream client used before start()')
+        host, breaker = self.breaker(url)
+        for attempt in range(self.attempts):
+            breaker.before_call(host)
+            try:
+                async with self.session.get(url, headers=headers, params=params) as response:
+                    if response.status >= 500 or response.status == 429:
+                        response.raise_for_status()
+                    breaker.succeeded()
+                    response.raise_for_status()
+                    if response.status == 304:
+                        return response.status, response.headers, None
+                    return response.status, response.headers, await response.json()
+            except ClientResponseError as e:
+                if e.status < 500 and e.status != 429:
+                    raise
+                error = e
+            except (ClientError, asyncio.TimeoutError) as e:
+                error = e
+            breaker.failed()
+            if attempt + 1 == self.attempts or breaker.is_open:
+                raise error
+            delay = self.backoff(attempt)
+            logger.warning(f'GET {url} failed ({error!r}), retrying in {delay:.2f}s')
+            await asyncio.sleep(delay)
+
+# flake8: noqa: E501
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 from copy import deepcopy
 from sanic import Blueprint, response
@@ -11,8 +12,17 @@ from rasa.shared.core.constants import USER_INTENT_RESTART
 from rasa.shared.exceptions import RasaException
 from rasa.utils.endpoints import EndpointConfig, ClientResponseError
 
+from channels.coalescing import MessageCoalescer
+from channels.conversation_queues import ConversationQueues, QueueFull
+from channels.deduplication import Deduplicator
+from channels.outbound import ChatwootSender
+from channels.rate_limit import AccountRateLimiter
+
 logger = logging.getLogger(__name__)
 
+# how often a merged message waits for room in the queues before checking again
+QUEUE_WAIT_SECONDS = 0.2
+
 
 class ChatwootOutput(OutputChannel):
     """Output channel for Chatwoot."""
@@ -22,24 +32,36 @@ class ChatwootOutput(OutputChannel):
     def name(cls) -> Text:
         return "chatwoot"
 
-    def __init__(self, endpoint: EndpointConfig, account_id: Text, conversation_id: Text) -> None:
+    def __init__(
+        self,
+        endpoint: EndpointConfig,
+        account_id: Text,
+        conversation_id: Text,
+        sender: Optional[ChatwootSender] = None,
+        split_paragraphs: bool = True,
+    ) -> None:
         logger.debug(f'Initialising output channel {__name__} with url: {endpoint.url}')
         self.callback_endpoint = endpoint
         self.account_id = account_id
         self.conversation_id = conversation_id
+        self.sender = sender
+        self.split_paragraphs = split_paragraphs
         super().__init__()
 
     async def send_message(self, recipient_id: Text, text: Text, reply_markup: Dict = None) -> None:
         path = f'/api/v1/accounts/{self.account_id}/conversations/{self.conversation_id}'
         logger.debug(f'send_message: recipient_id: {recipient_id}, text: {text}, reply_markup: {reply_markup}, path: {path}')
+        if reply_markup:
+            payload = reply_markup
+        else:
+            payload = {'content': text}
+        if self.sender:
+            await self.sender.send(self.account_id, self.conversation_id, f'{path}/messages', payload)
+            return
         try:
             # await self.callback_endpoint.request(
             #     "post", content_type="application/json", subpath=f'{path}/toggle_typing_status?typing_status=on'
             # )
-            if reply_markup:
-                payload = reply_markup
-            else:
-                payload = {'content': text}
             await self.callback_endpoint.request(
                 "post", content_type="application/json", subpath=f'{path}/messages', 
                 json=payload
@@ -58,6 +80,9 @@ class ChatwootOutput(OutputChannel):
         self, recipient_id: Text, text: Text, **kwargs: Any
     ) -> None:
         """Sends text message."""
+        if not self.split_paragraphs:
+            await self.send_message(recipient_id, text.strip())
+            return
         for message_part in text.strip().split("\n\n"):
             await self.send_message(recipient_id, message_part)
 
@@ -163,18 +188,79 @@ class ChatwootInput(InputChannel):
 
     @classmethod
     def from_credentials(cls, credentials: Optional[Dict[Text, Any]]) -> InputChannel:
+        # options of the channel, the rest of the credentials configures the Chatwoot endpoint
+        async_webhook = str(credentials.pop('async_webhook', False)).lower() in ('true', '1')
+        webhook_options = {
+            key: float(credentials.pop(key)) for key in list(credentials) if key.startswith(('webhook_', 'coalesce_'))
+        }
+        deduplicator = cls._deduplicator_from_credentials(credentials)
+        split_paragraphs = str(credentials.pop('split_paragraphs', True)).lower() in ('true', '1')
+        outbound_background = str(credentials.pop('outbound_background', False)).lower() in ('true', '1')
+        limiter = cls._limiter_from_credentials(credentials)
+        outbound_options = {
+            key[len('outbound_'):]: float(credentials.pop(key)) for key in list(credentials) if key.startswith('outbound_')
+        }
         credentials.update({
             'headers': {
                 'Content-Type': 'application/json',
                 'api_access_token': credentials.get('api_access_token')
             }
         })
-        return cls(EndpointConfig.from_dict(credentials))
+        endpoint = EndpointConfig.from_dict(credentials)
+        sender = ChatwootSender(
+            endpoint, background=outbound_background, limiter=limiter, **outbound_options
+        )
+        return cls(endpoint, async_webhook=async_webhook, deduplicator=deduplicator,
+                   sender=sender, split_paragraphs=split_paragraphs, **webhook_options)
 
-    def __init__(self, endpoint: EndpointConfig) -> None:
+    @staticmethod
+    def _deduplicator_from_credentials(credentials: Dict[Text, Any]) -> Optional[Deduplicator]:
+        ttl_seconds = float(credentials.pop('dedup_ttl_seconds', 600))
+        max_size = int(credentials.pop('dedup_max_size', 100000))
+        shared = str(credentials.pop('dedup_redis', False)).lower() in ('true', '1')
+        endpoints_file = credentials.pop('endpoints', 'endpoints.yml')
+        if ttl_seconds <= 0:
+            return None
+        if shared:
+            return Deduplicator.with_lock_store_redis(ttl_seconds, max_size, endpoints_file)
+        return Deduplicator(ttl_seconds, max_size)
+
+    @staticmethod
+    def _limiter_from_credentials(credentials: Dict[Text, Any]) -> Optional[AccountRateLimiter]:
+        rate = float(credentials.pop('rate_limit_per_second', 20))
+        burst = float(credentials.pop('rate_limit_burst', 2 * rate))
+        max_waiting = int(credentials.pop('rate_limit_max_waiting', 1000))
+        if rate <= 0:
+            return None
+        return AccountRateLimiter(rate, burst, max_waiting=max_waiting)
+
+    def __init__(
+        self,
+        endpoint: EndpointConfig,
+        async_webhook: bool = False,
+        webhook_concurrency: int = 32,
+        webhook_queue_size: int = 1000,
+        webhook_conversation_queue_size: int = 20,
+        webhook_drain_seconds: float = 30,
+        deduplicator: Optional[Deduplicator] = None,
+        coalesce_window_ms: float = 0,
+        coalesce_max_wait_ms: float = 3000,
+        sender: Optional[ChatwootSender] = None,
+        split_paragraphs: bool = True,
+    ) -> None:
         logger.debug(f'Initialising input channel {__name__} with config: {vars(endpoint)}')
         self.callback_endpoint = endpoint
         self.debug_mode = False
+        self.async_webhook = async_webhook
+        self.webhook_concurrency = int(webhook_concurrency)
+        self.webhook_queue_size = int(webhook_queue_size)
+        self.webhook_conversation_queue_size = int(webhook_conversation_queue_size)
+        self.webhook_drain_seconds = webhook_drain_seconds
+        self.deduplicator = deduplicator
+        self.coalesce_window_ms = coalesce_window_ms
+        self.coalesce_max_wait_ms = coalesce_max_wait_ms
+        self.sender = sender or ChatwootSender(endpoint)
+        self.split_paragraphs = split_paragraphs
 
     @staticmethod
     def _is_valid_chatwoot_event(event: Dict[Text, Any]) -> bool:
@@ -209,6 +295,46 @@ class ChatwootInput(InputChannel):
     ) -> Blueprint:
         chatwoot_webhook = Blueprint("chatwoot_webhook", __name__)
 
+        async def handle_messages(messages: List[UserMessage]) -> None:
+            for user_message in messages:
+                await on_new_message(user_message)
+
+        # in async mode the webhook is acknowledged once the messages are queued
+        queues = ConversationQueues(
+            handle_messages, self.webhook_concurrency, self.webhook_queue_size, self.webhook_conversation_queue_size
+        ) if self.async_webhook else None
+
+        async def dispatch(conversation: Any, messages: List[UserMessage]) -> None:
+            if not queues:
+                await handle_messages(messages)
+                return
+            # the webhooks have been acknowledged already, so the merged messages wait
+            # for room, the following bursts of the conversation wait for them
+            waiting = False
+            while not queues.closed:
+                try:
+                    queues.submit(conversation, messages)
+                    return
+                except QueueFull as e:
+                    if not waiting:
+                        logger.warning(f"Waiting to queue merged messages of conversation {conversation}: {e}")
+                        waiting = True
+                    await asyncio.sleep(QUEUE_WAIT_SECONDS)
+            await handle_messages(messages)
+
+        # messages sent in quick succession are handled as a single message
+        coalescer = MessageCoalescer(
+            self.coalesce_window_ms / 1000, self.coalesce_max_wait_ms / 1000, dispatch
+        ) if self.coalesce_window_ms > 0 else None
+
+        @chatwoot_webhook.listener("before_server_stop")
+        async def drain_queues(app, loop) -> None:
+            if coalescer:
+                await coalescer.flush_all()
+            if queues:
+                await queues.drain(self.webhook_drain_seconds)
+            # answers of the messages handled above are sent before the connections are closed
+            await self.sender.close(self.webhook_drain_seconds)
 
         @chatwoot_webhook.route("/", methods=["GET"])
         async def health(_: Request) -> HTTPResponse:
@@ -229,38 +355,57 @@ class ChatwootInput(InputChannel):
             account_id = metadata.get('account').get('id')
             conversation_id = metadata.get('conversation').get('id')
 
-            out_channel = ChatwootOutput(self.callback_endpoint, account_id, conversation_id)
+            # chatwoot retries webhooks, and with several replicas a message may arrive at more than one
+            delivery_key = f"{account_id}:{event.get('id')}"
+            if self.deduplicator and event.get('id') is not None \
+                    and not await self.deduplicator.first_delivery(delivery_key):
+                logger.debug(f'Skipped duplicate delivery of message {delivery_key}')
+                return response.text("Skipped duplicate event")
+
+            out_channel = ChatwootOutput(
+                self.callback_endpoint, account_id, conversation_id, self.sender, self.split_paragraphs
+            )
+
+            texts = [text, "/start"] if text == (INTENT_MESSAGE_PREFIX + USER_INTENT_RESTART) else [text]
+            messages = [
+                UserMessage(
+                    message_text,
+                    out_channel,
+                    sender_id,
+                    input_channel=self.name(),
+                    metadata=metadata,
+                )
+                for message_text in texts
+            ]
+
+            conversation = (account_id, conversation_id)
+            if queues:
+                try:
+                    if coalescer:
+                        # the messages are queued when the burst ends
+                        queues.check(conversation)
+                    else:
+                        queues.submit(conversation, messages)
+                except QueueFull as e:
+                    logger.warning(f"Rejected message of conversation {conversation_id}: {e}")
+                    if self.deduplicator:
+                        # the message is delivered again after Retry-After
+                        await self.deduplicator.forget(delivery_key)
+                    return response.text(str(e), status=e.status, headers={"Retry-After": "1"})
+
+            if coalescer and text and not text.startswith(INTENT_MESSAGE_PREFIX):
+                dispatched = coalescer.add(conversation, messages[0], event.get('id'))
+            elif coalescer:
+                # intents and commands like /restart are never merged with other messages
+                dispatched = coalescer.dispatch_alone(conversation, messages)
+            if queues:
+                return response.text("queued")
 
             try:
-                if text == (INTENT_MESSAGE_PREFIX + USER_INTENT_RESTART):
-                    await on_new_message(
-                        UserMessage(
-                            text,
-                            out_channel,
-                            sender_id,
-                            input_channel=self.name(),
-                            metadata=metadata,
-                        )
-                    )
-                    await on_new_message(
-                        UserMessage(
-                            "/start",
-                            out_channel,
-                            sender_id,
-                            input_channel=self.name(),
-                            metadata=metadata,
-                        )
-                    )
+                if coalescer:
+                    await asyncio.shield(dispatched)
                 else:
-                    await on_new_message(
-                        UserMessage(
-                            text,
-                            out_channel,
-                            sender_id,
-                            input_channel=self.name(),
-                            metadata=metadata,
-                        )
-                    )
+                    await handle_messages(messages)
             except Exception as e:
                 logger.error(f"Exception when trying to handle message.{e}")
                 logger.debug(e, exc_info=True)
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+
+from rasa.core.channels.channel import UserMessage
+
+logger = logging.getLogger(__name__)
+
+
+class Burst:
+    def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+        self.messages: List[UserMessage] = []
+        self.message_ids: List[Any] = []
+        self.started = loop.time()
+        self.timer: Optional[asyncio.TimerHandle] = None
+        # resolved once the merged message has been dispatched, with the result of the dispatch
+        self.dispatched = loop.create_future()
+
+
+def merge(messages: List[UserMessage], message_ids: List[Any]) -> UserMessage:
+    """One user message with the texts of a burst, the ids of the merged Chatwoot messages are kept in the metadata."""
+    last = messages[-1]
+    metadata = dict(last.metadata or {}, message_ids=message_ids)
+    return UserMessage(
+        "\n".join(message.text for message in messages if message.text),
+        last.output_channel,
+        last.sender_id,
+        input_channel=last.input_channel,
+        metadata=metadata,
+    )
+
+
+class MessageCoalescer:
+    """Merge messages a user sends in quick succession into a single user message.
+
+    A burst of a conversation is dispatched when no message arrived for
+    `window_seconds`, but at the latest `max_wait_seconds` after its first
+    message, so merging never delays an answer by more than that. `dispatch` is
+    called with the conversation and the messages to handle, in order.
+    """
+
+    def __init__(
+        self,
+        window_seconds: float,
+        max_wait_seconds: float,
+        dispatch: Callable[[Hashable, List[UserMessage]], Awaitable[Any]],
+    ) -> None:
+        self.window_seconds = window_seconds
+        self.max_wait_seconds = max_wait_seconds
+        self.dispatch = dispatch
+        self.bursts: Dict[Hashable, Burst] = {}
+        # the last dispatch of each conversation which has not finished yet
+        self.dispatching: Dict[Hashable, "asyncio.Future[Any]"] = {}
+
+    def add(self, conversation_id: Hashable, message: UserMessage, message_id: Any) -> "asyncio.Future[Any]":
+        """Add a message to the burst of its conversation, returns a future resolved once the burst is dispatched."""
+        loop = asyncio.get_event_loop()
+        burst = self.bursts.get(conversation_id)
+        if burst is None:
+            burst = self.bursts[conversation_id] = Burst(loop)
+        burst.messages.append(message)
+        burst.message_ids.append(message_id)
+
+        if burst.timer:
+            burst.timer.cancel()
+        delay = min(self.window_seconds, burst.started + self.max_wait_seconds - loop.time())
+        burst.timer = loop.call_later(max(0.0, delay), self.flush, conversation_id)
+        return burst.dispatched
+
+    def dispatch_alone(self, conversation_id: Hashable, messages: List[UserMessage]) -> "asyncio.Future[Any]":
+        """Dispatch messages which must not be merged, like commands, after the pending burst of the conversation."""
+        self.flush(conversation_id)
+        dispatched = asyncio.get_event_loop().create_future()
+        self._dispatch_in_order(conversation_id, messages, dispatched)
+        return dispatched
+
+    def flush(self, conversation_id: Hashable) -> Optional["asyncio.Future[Any]"]:
+        """Dispatch the burst of a conversation now."""
+        burst = self.bursts.pop(conversation_id, None)
+        if burst is None:
+            return None
+        if burst.timer:
+            burst.timer.cancel()
+        if len(burst.messages) > 1:
+            logger.debug(f"Merged {len(burst.messages)} messages of conversation {conversation_id}: {burst.message_ids}")
+        self._dispatch_in_order(conversation_id, [merge(burst.messages, burst.message_ids)], burst.dispatched)
+        return burst.dispatched
+
+    def _dispatch_in_order(self, conversation_id: Hashable, messages: List[UserMessage], dispatched: "asyncio.Future[Any]") -> None:
+        # a dispatch starts after the previous one of the conversation finished
+        previous = self.dispatching.get(conversation_id)
+        self.dispatching[conversation_id] = dispatched
+        asyncio.ensure_future(self._dispatch(conversation_id, messages, dispatched, previous))
+
+    async def _dispatch(
+        self,
+        conversation_id: Hashable,
+        messages: List[UserMessage],
+        dispatched: "asyncio.Future[Any]",
+        previous: Optional["asyncio.Future[Any]"],
+    ) -> None:
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            dispatched.set_result(await self.dispatch(conversation_id, messages))
+        except Exception as e:
+            dispatched.set_exception(e)
+            # marks the exception as retrieved, callers which don't wait for the dispatch don't care
+            dispatched.exception()
+        finally:
+            if self.dispatching.get(conversation_id) is dispatched:
+                del self.dispatching[conversation_id]
+
+    async def flush_all(self) -> None:
+        """Dispatch all bursts now and wait until all dispatches finished."""
+        for conversation_id in list(self.bursts):
+            self.flush(conversation_id)
+        if self.dispatching:
+            await asyncio.wait(list(self.dispatching.values()))
+
+# flake8: noqa: E501
@@ -0,0 +1,98 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """Raised when a message can't be queued, `status` is the HTTP status to answer with."""
+
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+class ConversationQueues:
+    """Handle queued items in order within a conversation, and concurrently across conversations.
+
+    Every conversation has its own queue, worked off by a single task, so the
+    items of a conversation are handled one after the other. At most
+    `max_concurrency` items are handled at the same time over all conversations.
+    Submitting fails with 503 when `max_pending` items are waiting overall, and
+    with 429 when `max_pending_per_conversation` are waiting in the conversation.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[Any], Awaitable[Any]],
+        max_concurrency: int,
+        max_pending: int,
+        max_pending_per_conversation: int,
+    ) -> None:
+        self.handler = handler
+        self.max_concurrency = max_concurrency
+        self.max_pending = max_pending
+        self.max_pending_per_conversation = max_pending_per_conversation
+        self.queues: Dict[Hashable, Deque[Any]] = {}
+        self.tasks: Set[asyncio.Task] = set()
+        self.pending = 0
+        self.closed = False
+        # created in the event loop of the server
+        self.semaphore: Optional[asyncio.Semaphore] = None
+
+    def check(self, conversation_id: Hashable) -> None:
+        """Raise `QueueFull` if an item of the conversation can't be queued now."""
+        if self.closed:
+            raise QueueFull(503, "Shutting down")
+        if self.pending >= self.max_pending:
+            raise QueueFull(503, "Too many messages waiting")
+        queue = self.queues.get(conversation_id)
+        if queue is not None and len(queue) >= self.max_pending_per_conversation:
+            raise QueueFull(429, "Too many messages waiting in this conversation")
+
+    def submit(self, conversation_id: Hashable, item: Any) -> None:
+        self.check(conversation_id)
+        queue = self.queues.get(conversation_id)
+        self.pending += 1
+        if queue is None:
+            queue = self.queues[conversation_id] = deque([item])
+            task = asyncio.ensure_future(self._work_off(conversation_id, queue))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        else:
+            queue.append(item)
+
+    async def _work_off(self, conversation_id: Hashable, queue: Deque[Any]) -> None:
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        try:
+            while queue:
+                async with self.semaphore:
+                    try:
+                        await self.handler(queue[0])
+                    except Exception as e:
+                        logger.error(f"Exception when handling a message of conversation {conversation_id}: {e}")
+                        logger.debug(e, exc_info=True)
+                queue.popleft()
+                self.pending -= 1
+        finally:
+            # nothing is awaited between the last check of the queue and here,
+            # so no item can be added to a queue which is not worked off anymore
+            self.pending -= len(queue)
+            del self.queues[conversation_id]
+
+    async def drain(self, timeout: float) -> None:
+        """Stop taking new items and wait up to `timeout` seconds for the queued ones."""
+        self.closed = True
+        if not self.tasks:
+            return
+        logger.info(f"Waiting for {self.pending} queued messages of {len(self.queues)} conversations")
+        _, not_done = await asyncio.wait(list(self.tasks), timeout=timeout)
+        if not_done:
+            logger.warning(f"Dropping {self.pending} queued messages of {len(not_done)} conversations")
+            for task in not_done:
+                task.cancel()
+
+# flake8: noqa: E501
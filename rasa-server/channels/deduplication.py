@@ -0,0 +1,98 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Optional, Text
+
+from rasa.utils.endpoints import EndpointConfig
+
+logger = logging.getLogger(__name__)
+
+# keys of delivered messages in redis, next to the locks of the lock store
+REDIS_KEY_PREFIX = "chatwoot_delivered:"
+
+
+class SeenSet:
+    """Keys seen within the last `ttl_seconds`, holding at most `max_size` keys."""
+
+    def __init__(self, ttl_seconds: float, max_size: int) -> None:
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        # key -> expiry, in order of insertion, which is also the order of expiry
+        self.seen: "OrderedDict[Text, float]" = OrderedDict()
+
+    def add(self, key: Text) -> bool:
+        """Remember a key, returns False if it has been seen already."""
+        now = time.monotonic()
+        while self.seen and next(iter(self.seen.values())) <= now:
+            self.seen.popitem(last=False)
+        if key in self.seen:
+            return False
+        # only a new key makes room, so the keys seen again stay recognized
+        while self.seen and len(self.seen) >= self.max_size:
+            self.seen.popitem(last=False)
+        self.seen[key] = now + self.ttl_seconds
+        return True
+
+    def discard(self, key: Text) -> None:
+        self.seen.pop(key, None)
+
+
+class Deduplicator:
+    """Recognizes webhook deliveries of messages which have been delivered before.
+
+    Deliveries are first checked against the keys seen by this process. With a
+    redis client, the keys are also set in redis, so that a message delivered to
+    several replicas is handled by only one of them. If redis fails, deliveries
+    are only deduplicated within this process.
+    """
+
+    def __init__(self, ttl_seconds: float, max_size: int, redis: Optional[Any] = None) -> None:
+        self.seen = SeenSet(ttl_seconds, max_size)
+        self.ttl_seconds = ttl_seconds
+        self.redis = redis
+
+    @classmethod
+    def with_lock_store_redis(cls, ttl_seconds: float, max_size: int, endpoints_file: Text) -> "Deduplicator":
+        """Share the deliveries across replicas through the redis of the lock store in the endpoints file."""
+        from rasa.utils.endpoints import read_endpoint_config
+
+        lock_store = read_endpoint_config(endpoints_file, endpoint_type="lock_store")
+        if lock_store is None or lock_store.type != "redis":
+            logger.warning(f"No redis lock store in {endpoints_file}, deduplicating webhooks within this process only")
+            return cls(ttl_seconds, max_size)
+        return cls(ttl_seconds, max_size, redis_client(lock_store))
+
+    async def first_delivery(self, key: Text) -> bool:
+        if not self.seen.add(key):
+            return False
+        if self.redis is None:
+            return True
+        try:
+            return bool(await self.redis.set(REDIS_KEY_PREFIX + key, 1, nx=True, ex=max(1, int(self.ttl_seconds))))
+        except Exception as e:
+            logger.warning(f"Failed to check delivery {key} in redis: {e}")
+            return True
+
+    async def forget(self, key: Text) -> None:
+        """Accept the next delivery of a message again, e.g. because it couldn't be handled."""
+        self.seen.discard(key)
+        if self.redis is not None:
+            try:
+                await self.redis.delete(REDIS_KEY_PREFIX + key)
+            except Exception as e:
+                logger.warning(f"Failed to forget delivery {key} in redis: {e}")
+
+
+def redis_client(lock_store: EndpointConfig) -> Any:
+    """Async redis client with the connection settings of the redis lock store."""
+    from redis.asyncio import StrictRedis
+
+    return StrictRedis(
+        host=lock_store.url,
+        port=int(lock_store.kwargs.get("port") or 6379),
+        db=int(lock_store.kwargs.get("db") or 1),
+        password=lock_store.kwargs.get("password"),
+        ssl=str(lock_store.kwargs.get("use_ssl", False)).lower() in ("true", "1"),
+    )
+
+# flake8: noqa: E501
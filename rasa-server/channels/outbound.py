@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Any, Dict, Hashable, Optional, Text, Tuple
+
+import aiohttp
+from rasa.utils.endpoints import EndpointConfig, concat_url
+
+from channels.conversation_queues import ConversationQueues, QueueFull
+from channels.rate_limit import AccountRateLimiter, parse_retry_after
+
+logger = logging.getLogger(__name__)
+
+# answers for which Chatwoot has not created the message, so sending it again is safe
+RETRY_STATUSES = {429, 502, 503, 504}
+
+
+class DeliveryFailed(Exception):
+    pass
+
+
+class ChatwootSender:
+    """Sends messages to the Chatwoot API over a pool of keep-alive connections.
+
+    In the background mode, messages are queued per conversation and sent one
+    after the other, so Chatwoot shows them in the order the bot sent them, while
+    the bot turn doesn't wait for them. Messages of different conversations are
+    sent concurrently. Connection errors and overload answers are retried with
+    exponential backoff and jitter, timeouts are not because Chatwoot may have
+    created the message already.
+
+    With a `limiter`, messages of an account are sent at the rate Chatwoot
+    accepts, and messages answered with 429 are sent again once the limiter
+    allows it, until `deadline_seconds` after they were first sent.
+    """
+
+    def __init__(
+        self,
+        endpoint: EndpointConfig,
+        background: bool = False,
+        pool_size: int = 32,
+        timeout_seconds: float = 10,
+        attempts: int = 3,
+        backoff_seconds: float = 0.2,
+        max_backoff_seconds: float = 5,
+        queue_size: int = 1000,
+        conversation_queue_size: int = 100,
+        limiter: Optional[AccountRateLimiter] = None,
+        deadline_seconds: float = 60,
+    ) -> None:
+        self.endpoint = endpoint
+        self.pool_size = int(pool_size)
+        self.timeout_seconds = timeout_seconds
+        self.attempts = max(1, int(attempts))
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.limiter = limiter
+        self.deadline_seconds = deadline_seconds
+        self.queues = ConversationQueues(
+            self._deliver, self.pool_size, int(queue_size), int(conversation_queue_size)
+        ) if background else None
+        # created in the event loop of the server
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    def _session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60),
+                headers=self.endpoint.headers,
+                timeout=aiohttp.ClientTimeout(total=self.timeout_seconds),
+            )
+        return self.session
+
+    async def send(self, account_id: Hashable, conversation_id: Hashable, subpath: Text, payload: Dict[Text, Any]) -> None:
+        """Post a message to a path of the Chatwoot API, after the earlier messages of the conversation."""
+        item = (account_id, subpath, payload)
+        if self.queues is None:
+            await self._deliver(item)
+            return
+        waiting = False
+        while not self.queues.closed:
+            try:
+                self.queues.submit((account_id, conversation_id), item)
+                return
+            except QueueFull as e:
+                # the bot turn waits until Chatwoot caught up
+                if not waiting:
+                    logger.warning(f"Waiting to send message of conversation {conversation_id}: {e}")
+                    waiting = True
+                await asyncio.sleep(self.backoff_seconds)
+        await self._deliver(item)
+
+    async def _deliver(self, item: Tuple[Hashable, Text, Dict[Text, Any]]) -> None:
+        account_id, subpath, payload = item
+        try:
+            await self._post(account_id, concat_url(self.endpoint.url, subpath), payload)
+        except Exception as e:
+            logger.error(f"Failed to send output message to callback. {e}")
+
+    async def _post(self, account_id: Hashable, url: Text, payload: Dict[Text, Any]) -> None:
+        deadline = time.monotonic() + self.deadline_seconds
+        attempt = 0
+        while True:
+            if self.limiter:
+                await self.limiter.acquire(account_id, deadline)
+            retry_after = None
+            try:
+                async with self._session().post(url, json=payload) as resp:
+                    if resp.status < 400:
+                        if self.limiter:
+                            self.limiter.succeeded(account_id)
+                        return
+                    error = f"Status: {resp.status} Response: {await resp.text()}"
+                    retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+                    if resp.status == 429 and self.limiter:
+                        # sent again when the limiter allows it, which doesn't count as an attempt
+                        self.limiter.throttled(account_id, retry_after)
+                        continue
+                    if resp.status not in RETRY_STATUSES:
+                        raise DeliveryFailed(error)
+            except asyncio.TimeoutError:
+                raise DeliveryFailed(f"No answer within {self.timeout_seconds} seconds")
+            except aiohttp.ClientConnectionError as e:
+                error = f"Connection error: {e}"
+            attempt += 1
+            if attempt == self.attempts:
+                raise DeliveryFailed(error)
+            delay = random.uniform(0, min(self.max_backoff_seconds, self.backoff_seconds * 2 ** attempt))
+            if retry_after:
+                delay = max(delay, min(self.max_backoff_seconds, retry_after))
+            logger.debug(f"Sending to {url} failed ({error}), retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+    async def close(self, timeout: float) -> None:
+        """Send the queued messages for up to `timeout` seconds and close the connections."""
+        if self.queues:
+            await self.queues.drain(timeout)
+        if self.session is not None:
+            await self.session.close()
+
+# flake8: noqa: E501